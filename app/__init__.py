@@ -1,3 +1,4 @@
+import click
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
@@ -12,7 +13,7 @@ login_manager.login_view = 'main.login'  # Redirect to login page if not authent
 login_manager.login_message = "Please log in to access this page."
 login_manager.login_message_category = "warning"
 
-def create_app():
+def create_app(upgrade_schema=False):
     app = Flask(__name__)
 
     app.config.from_object(Config)
@@ -21,12 +22,30 @@ def create_app():
     csrf.init_app(app)
     login_manager.init_app(app)
 
+    from . import cache, conditional, instrumentation, pagecache, profiling
+    cache.init_app(app)
+    conditional.init_app(app)
+    pagecache.init_app(app)
+    instrumentation.init_app(app)
+    profiling.init_app(app)
+
     from .routes import main
     app.register_blueprint(main)
 
+    from .commands import register_commands
+    register_commands(app)
+
     @login_manager.user_loader
     def load_user(user_id):
-        from app.models import Users
-        return Users.query.get(int(user_id))
+        return cache.load_user(int(user_id))
+
+    # The web app won't start on a database with migrations pending. flask commands (db-upgrade among
+    # them) load the app inside a click context and skip the check; python run.py upgrades instead.
+    from . import migrations
+    with app.app_context():
+        if upgrade_schema:
+            migrations.upgrade()
+        elif click.get_current_context(silent=True) is None:
+            migrations.check_schema()
 
     return app
@@ -0,0 +1,18 @@
+from functools import wraps
+
+from flask import abort, current_app
+from flask_login import current_user
+
+def is_admin(user):
+    # Admins are listed by email in the ADMIN_EMAILS setting
+    if not user.is_authenticated:
+        return False
+    return user.email.lower() in current_app.config['ADMIN_EMAILS']
+
+def admin_required(view):
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not is_admin(current_user):
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapped
@@ -0,0 +1,217 @@
+# Route benchmarks with query budgets.
+#
+# Every route on the main blueprint is driven through the Flask test client as one user, a few
+# times each. Latency and query counts come from the instrumentation layer's per-endpoint samples,
+# and a route fails when any of its requests runs more SQL statements than its budget or returns
+# an unexpected status. Write routes do change the user's data, so run this against a synthetic
+# database (flask generate-data) rather than a real one.
+
+import io
+from collections import namedtuple
+from datetime import date, timedelta
+from itertools import count
+from uuid import uuid4
+
+from sqlalchemy import func
+
+from . import db
+from .instrumentation import request_metrics
+from .models import Ingredient, Recipe, LogEntry, Users
+from .profiling import list_profiles
+from .timeline import TargetTimeline, group_slots
+
+# budget: the most SQL statements one request may run. Window routes are measured over the default
+# 10-day page; the full-page saves write one row per slot, so their budgets scale with that window.
+Probe = namedtuple('Probe', 'endpoint method path budget status data json')
+Probe.__new__.__defaults__ = (200, None, None)
+
+def _probes(ctx):
+    today = date.today().isoformat()
+    week_ago = (date.today() - timedelta(days=7)).isoformat()
+    ingredient_id = ctx['ingredient_id']
+    ingredient_fields = ctx['ingredient_fields']
+    recipe_id = ctx['recipe_id']
+    n = next(ctx['counter'])
+
+    return [
+        Probe('main.index', 'get', '/', 2),
+        Probe('main.ingredients', 'get', '/ingredients', 3),
+        Probe('main.add_ingredient', 'post', '/ingredients', 6, 302,
+              data={**ingredient_fields, 'name': f'Bench ingredient {ctx["run"]}-{n}'}),
+        Probe('main.import_ingredients_upload', 'get', '/ingredients/import', 2),
+        Probe('main.import_ingredients_upload', 'post', '/ingredients/import', 6, data={
+            'file': _upload('name,fat,carbs,protein\n' + ''.join(
+                f'Bench import {ctx["run"]}-{n}-{i},{i % 60},{i % 10},{i % 30}\n' for i in range(200)), 'bench.csv'),
+            'default_type': 'dairy', 'default_units': 'g'}),
+        Probe('main.search_ingredients', 'get', '/ingredients/search?q=a&measured=1', 2),
+        Probe('main.edit_ingredient', 'get', f'/ingredients/{ingredient_id}/edit', 4),
+        Probe('main.edit_ingredient', 'post', f'/ingredients/{ingredient_id}/edit', 11, 302, data=ingredient_fields),
+        Probe('main.recipes', 'get', '/recipes', 5),
+        Probe('main.new_recipe', 'get', '/recipes/new', 6),
+        Probe('main.new_recipe', 'post', '/recipes/new', 8, 302, data={
+            'name': f'Bench recipe {ctx["run"]}-{n}', 'author': 'home', 'meal_type': 'main',
+            'ingredients-0-ingredient_id': ingredient_id, 'ingredients-0-amount': 25}),
+        Probe('main.new_calculated_recipe', 'get', '/recipes/new_calculated', 3),
+        Probe('main.new_calculated_recipe', 'post', '/recipes/new_calculated', 6, 302, data={
+            'name': f'Bench calculated recipe {ctx["run"]}-{n}', 'author': 'hospital', 'meal_type': 'snack',
+            'ingredients-0-ingredient_id': ingredient_id, 'ingredients-0-amount': 25,
+            'total_fat': 30, 'total_carbs': 4, 'total_protein': 6, 'total_calories': 310, 'ratio': 3}),
+        Probe('main.targets', 'get', '/targets', 4),
+        Probe('main.targets', 'post', '/targets', 12, 302, data=ctx['target_form']),
+        Probe('main.login', 'get', '/login', 2, 302),
+        Probe('main.signup', 'get', '/signup', 2, 302),
+        Probe('main.planner', 'get', '/planner', 10),
+        Probe('main.planner', 'get', f'/planner?start={week_ago}&days=31', 10),
+        Probe('main.planner', 'post', '/planner', 60, 302, data=ctx['planner_form']),
+        Probe('main.planner_days', 'get', f'/planner/days?start={today}&until={today}', 9),
+        Probe('main.planner_slot', 'patch', '/planner/slot', 4,
+              json={'date': today, 'slot': 'Breakfast', 'recipe_id': recipe_id, 'notes': 'bench'}),
+        Probe('main.shopping_list', 'get', f'/planner/shopping_list?start={today}&days=7', 6),
+        Probe('main.log', 'get', '/log', 8),
+        Probe('main.log', 'get', f'/log?start={week_ago}&days=31', 8),
+        Probe('main.log', 'post', '/log', 65, 302, data=ctx['log_form']),
+        Probe('main.import_readings_upload', 'get', '/log/readings/import', 2),
+        Probe('main.import_readings_upload', 'post', '/log/readings/import', 6, data={
+            'file': _upload('timestamp,ketones,glucose\n' + ''.join(
+                f'{(date.today() - timedelta(days=i // 4)).isoformat()} {6 + i % 4 * 4:02d}:{n % 60:02d},'
+                f'{1 + i % 30 / 10:.1f},{4 + i % 20 / 10:.1f}\n' for i in range(400)), 'meter.csv')}),
+        Probe('main.log_days', 'get', f'/log/days?start={today}&until={today}', 8),
+        Probe('main.log_slot', 'patch', '/log/slot', 6,
+              json={'date': today, 'slot': 'Lunch', 'recipe_id': recipe_id, 'percent_eaten': 80}),
+        Probe('main.log_summary', 'get', '/log/summary', 3),
+        Probe('main.log_summary', 'get', f'/log/summary?year={date.today().year}', 3),
+        Probe('main.export', 'get', '/export/log.csv', 2),
+        Probe('main.export', 'get', f'/export/log.json?start={week_ago}&end={today}', 2),
+        Probe('main.export', 'get', '/export/ketones.csv', 2),
+        Probe('main.export', 'get', '/export/planner.json', 2),
+        Probe('main.export', 'get', '/export/recipes.csv', 2),
+        Probe('main.fruit_substitutions', 'get', '/fruit_substitutions', 2),
+        Probe('main.veg_substitutions', 'get', '/veg_substitutions', 2),
+        Probe('main.metrics', 'get', '/metrics', 1),
+        Probe('main.profiles', 'get', '/profiles', 1),
+        Probe('main.profile_detail', 'get', f'/profiles/{ctx["profile_id"]}', 1),
+        Probe('main.profile_download', 'get', f'/profiles/{ctx["profile_id"]}/download', 1),
+        Probe('main.logout', 'get', '/logout', 1, 302),
+    ]
+
+def _upload(content, filename):
+    # A file field value for the test client
+    return io.BytesIO(content.encode()), filename
+
+def _target_form(target):
+    # The latest target saved again, so the slots of every day stay as they were
+    data = {field: getattr(target, field) for field in (
+        'ratio', 'calories', 'fat', 'protein', 'carbs', 'num_main_meals', 'num_snacks')}
+    for b in target.breakdowns:
+        prefix = b.item.lower()
+        data.update({f'{prefix}_calories': b.calories, f'{prefix}_fat': b.fat,
+                     f'{prefix}_protein': b.protein, f'{prefix}_carbs': b.carbs})
+    return data
+
+def _window_form(timeline, recipe_id, log=False):
+    # A full-page save of the default 10-day window, as the browser would post it
+    days = [date.today() + timedelta(days=offset) for offset in range(10)]
+    _, slot_index_map = group_slots(timeline.slots(days))
+
+    data = {'loaded_day': [d.isoformat() for d in days]}
+    for idx in slot_index_map.values():
+        data[f'slot-{idx}-recipe_id'] = recipe_id
+        if log:
+            data[f'slot-{idx}-percent_eaten'] = 100
+    if log:
+        data['ketone_entries-0-date'] = date.today().isoformat()
+        data['ketone_entries-0-time'] = '07:30'
+        data['ketone_entries-0-ketone_level'] = 3.2
+    return data
+
+def _context(user_id):
+    timeline = TargetTimeline.load(user_id)
+    ingredient = (
+        Ingredient.query
+        .filter_by(user_id=user_id, unmeasured_ingredient=False)
+        .order_by(Ingredient.id)
+        .first()
+    )
+    recipe_id = db.session.query(func.min(Recipe.id)).filter(Recipe.user_id == user_id).scalar()
+    if not (timeline and ingredient and recipe_id):
+        raise ValueError('The benchmark user needs a target, an ingredient and a recipe; use flask generate-data.')
+    log_rows = db.session.query(func.count(LogEntry.id)).filter(LogEntry.user_id == user_id).scalar()
+
+    return {
+        'user_id': user_id,
+        'email': db.session.get(Users, user_id).email,
+        'ingredient_id': ingredient.id,
+        'ingredient_fields': {
+            'name': ingredient.name, 'source': ingredient.source or '', 'type': ingredient.type,
+            'units': ingredient.units, 'percent_fat': ingredient.percent_fat,
+            'percent_carbs': ingredient.percent_carbs, 'percent_protein': ingredient.percent_protein,
+            'total_calories': ingredient.total_calories,
+        },
+        'recipe_id': recipe_id,
+        'log_rows': log_rows,
+        'target_form': _target_form(timeline.latest),
+        'planner_form': _window_form(timeline, recipe_id),
+        'log_form': _window_form(timeline, recipe_id, log=True),
+        # Names of rows created by write routes must be unique across runs
+        'run': uuid4().hex[:8],
+        'counter': count(1),
+    }
+
+BenchResult = namedtuple('BenchResult', 'endpoint method path budget statuses stats failures')
+
+def _log_in(client, user_id):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+def run(app, user_id, repeat=5):
+    with app.app_context():
+        ctx = _context(user_id)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    # The admin pages are benchmarked too, so the benchmark user is an admin for the run
+    app.config['ADMIN_EMAILS'] = app.config['ADMIN_EMAILS'] | {ctx['email'].lower()}
+    app.logger.setLevel('WARNING')
+
+    client = app.test_client()
+    _log_in(client, user_id)
+
+    # A capture for the profile pages to show
+    with app.app_context():
+        client.get('/?profile=1')
+    ctx['profile_id'] = list_profiles(app.config['PROFILE_DIR'])[0]['id']
+
+    probes = _probes(ctx)
+    missing = {rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint.startswith('main.')}
+    missing -= {probe.endpoint for probe in probes}
+    if missing:
+        raise ValueError(f'No benchmark probe for {", ".join(sorted(missing))}; add one to app/benchmark.py.')
+
+    results = []
+    for i, probe in enumerate(probes):
+        statuses = []
+        failures = []
+        request_metrics.clear()
+        for _ in range(repeat):
+            # Rebuilt each time so writes that create rows use fresh names
+            probe = _probes(ctx)[i]
+            # Logged in afresh each time, as the logout probe ends the session
+            _log_in(client, user_id)
+            # The CLI already has an app context, which a request would reuse along with its g and
+            # session; push a fresh one per request as gunicorn would
+            with app.app_context():
+                response = getattr(client, probe.method)(probe.path, data=probe.data, json=probe.json)
+                # Streamed responses are recorded once sent and closed, as a server would
+                response.get_data()
+                response.close()
+            statuses.append(response.status_code)
+            if response.status_code != probe.status:
+                failures.append(f'status {response.status_code}, expected {probe.status}')
+
+        stats = request_metrics.snapshot().get(probe.endpoint, {})
+        worst = stats.get('queries', {}).get('max', 0)
+        if worst > probe.budget:
+            failures.append(f'{worst:g} queries, budget {probe.budget}')
+        results.append(BenchResult(probe.endpoint, probe.method.upper(), probe.path, probe.budget,
+                                   statuses, stats, failures))
+    return ctx, results
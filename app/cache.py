@@ -0,0 +1,154 @@
+# In-process caches of per-user data: reference data (the ingredient search index, recipe choice lists
+# and target timeline), and the snapshot of the logged-in user that Flask-Login loads on every request.
+#
+# Reference entries are keyed by (user id, kind, data version). Users.data_version is bumped in the same
+# transaction as any commit that adds ingredients, recipes or targets, so a bump makes the old entries
+# unreachable and they age out of the LRU. Each worker learns of bumps made by the others when it
+# reloads the user's snapshot, at most USER_CACHE_TTL seconds later. A browser's own bumps are also
+# remembered in its session as a floor that stays there, so no worker ever builds that browser a page
+# from a snapshot older than its last save.
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+
+from flask import has_request_context, session
+from flask_login import UserMixin
+from sqlalchemy import event, update
+
+from . import db
+from .models import Ingredient, Recipe, Users
+from .queries import owned
+from .search import IngredientIndex
+from .timeline import TargetTimeline
+
+class LRUCache:
+    # Entries older than ttl seconds (when set) are treated as missing
+    def __init__(self, maxsize=512, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (stored at, value)
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            stored_at, value = self._data[key]
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+reference_cache = LRUCache()
+user_cache = LRUCache()
+
+def init_app(app):
+    reference_cache.maxsize = app.config['REFERENCE_CACHE_SIZE']
+    user_cache.maxsize = app.config['USER_CACHE_SIZE']
+    user_cache.ttl = app.config['USER_CACHE_TTL']
+
+@dataclass(frozen=True)
+class UserSnapshot(UserMixin):
+    # The columns of a Users row that requests read through current_user; shared by every request of
+    # the user in this worker, so it is never changed in place
+    id: int
+    childsname: str
+    email: str
+    data_version: int
+
+def load_user(user_id):
+    # Flask-Login's user_loader: the cached snapshot unless it is older than the data version this
+    # browser last wrote. That floor stays in the session, as other workers may still hold older snapshots.
+    snapshot = user_cache.get(user_id)
+    written = session.get('_data_version')
+    if snapshot is None or (written and written[0] == user_id and written[1] > snapshot.data_version):
+        row = (
+            db.session.query(Users.id, Users.childsname, Users.email, Users.data_version)
+            .filter(Users.id == user_id)
+            .first()
+        )
+        if row is None:
+            user_cache.discard(user_id)
+            return None
+        snapshot = UserSnapshot(*row)
+        user_cache.set(user_id, snapshot)
+        if written and written[0] == user_id and written[1] > snapshot.data_version:
+            # Left behind by a transaction that was rolled back, or a reset database: the floor comes down
+            # to what is stored, or every request would reload
+            session['_data_version'] = (user_id, snapshot.data_version)
+    return snapshot
+
+@event.listens_for(Users, 'after_update')
+@event.listens_for(Users, 'after_delete')
+def _forget_user(mapper, connection, user):
+    # An edited email or password, or a deleted account, is seen on the user's next request
+    user_cache.discard(user.id)
+
+def bump_data_version(user_id):
+    version = db.session.execute(
+        update(Users).where(Users.id == user_id).values(data_version=Users.data_version + 1)
+        .returning(Users.data_version)
+    ).scalar()
+    user_cache.discard(user_id)
+    if has_request_context() and session.get('_user_id') == str(user_id):
+        session['_data_version'] = (user_id, version)
+
+def _cached(user, kind, build):
+    key = (user.id, kind, user.data_version)
+    value = reference_cache.get(key)
+    if value is None:
+        value = build()
+        reference_cache.set(key, value)
+    return value
+
+def ingredient_index(user):
+    # Search index and id -> label maps of the user's ingredients, for the recipe pages
+    def build():
+        rows = (
+            owned(Ingredient, user.id)
+            .with_entities(
+                Ingredient.id, Ingredient.name, Ingredient.source, Ingredient.units, Ingredient.percent_fat,
+                Ingredient.percent_carbs, Ingredient.percent_protein, Ingredient.total_calories,
+                Ingredient.unmeasured_ingredient)
+            .all()
+        )
+        return IngredientIndex(rows)
+    return _cached(user, 'ingredient_index', build)
+
+def recipe_choices(user):
+    # Recipe dropdown for the planner and log, including the blank and custom options
+    def build():
+        rows = (
+            owned(Recipe, user.id)
+            .with_entities(Recipe.id, Recipe.name)
+            .order_by(Recipe.name)
+            .all()
+        )
+        return [(0, '-- Select --')] + [(r_id, name) for r_id, name in rows] + [(-1, 'CUSTOM')]
+    return _cached(user, 'recipe_choices', build)
+
+def target_timeline(user):
+    # Every target the user has set, for looking up the one in force on each day of a page
+    return _cached(user, 'target_timeline', lambda: TargetTimeline.load(user.id))
+
+def recipe_labels(user):
+    # Recipe id -> dropdown label, for rendering only the chosen option of each planner/log slot
+    return _cached(user, 'recipe_labels', lambda: dict(recipe_choices(user)))
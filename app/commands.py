@@ -0,0 +1,250 @@
+from time import perf_counter
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from . import db, migrations, synthetic, benchmark, loadtest
+from .cache import bump_data_version
+from .importer import import_ingredients, format_for, FORMATS as IMPORT_FORMATS
+from .models import LogEntry, Recipe, Users
+from .readings import import_readings
+from .nutrition import recompute_recipes
+from .summaries import refresh_summaries
+
+@click.command('db-upgrade')
+@with_appcontext
+def db_upgrade():
+    """Create missing tables and apply pending schema migrations."""
+    applied = migrations.upgrade()
+    for version, description in applied:
+        click.echo(f'Applied migration {version}: {description}')
+    if not applied:
+        click.echo('Database schema is up to date.')
+
+@click.command('recompute-recipes')
+@click.option('--user', 'user_id', type=int, help='Only recompute this user\'s recipes.')
+@click.option('--dry-run', is_flag=True, help='Report ratio changes without saving them.')
+@with_appcontext
+def recompute_recipes_command(user_id, dry_run):
+    """Recalculate macros and ratios of every ingredient-based recipe."""
+    started = perf_counter()
+    changes = recompute_recipes(user_id=user_id)
+    elapsed = (perf_counter() - started) * 1000
+
+    for recipe_id, old_ratio, new_ratio in changes:
+        if old_ratio is None or new_ratio is None or abs(old_ratio - new_ratio) > 0.005:
+            click.echo(f'Recipe {recipe_id}: ratio {old_ratio} -> {new_ratio}')
+
+    if dry_run:
+        db.session.rollback()
+    else:
+        # The recipes pages are served from each user's data version, so it must move with the macros
+        user_ids = [user_id] if user_id else db.session.scalars(select(Recipe.user_id).distinct()).all()
+        changed = [recipe_id for recipe_id, _, _ in changes]
+        for uid in user_ids:
+            refresh_summaries(uid, recipe_ids=changed)
+            bump_data_version(uid)
+        db.session.commit()
+    click.echo(f'Recomputed {len(changes)} recipes in {elapsed:.1f} ms{" (dry run)" if dry_run else ""}.')
+
+@click.command('backfill-summaries')
+@click.option('--user', 'childsname', help='Only this child\'s log; defaults to everyone with a log.')
+@with_appcontext
+def backfill_summaries(childsname):
+    """Rebuild the daily intake summaries from the whole meal log."""
+    # The daily_summary table comes with the schema upgrade, which is left to db-upgrade
+    try:
+        migrations.check_schema()
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    if childsname:
+        user = Users.query.filter_by(childsname=childsname).first()
+        if not user:
+            raise click.ClickException(f'No user called {childsname}.')
+        user_ids = [user.id]
+    else:
+        user_ids = db.session.scalars(select(LogEntry.user_id).distinct().order_by(LogEntry.user_id)).all()
+
+    started = perf_counter()
+    days = 0
+    for uid in user_ids:
+        # One transaction per family, so an interrupted backfill keeps what it has done
+        days += refresh_summaries(uid)
+        db.session.commit()
+    click.echo(f'Summarised {days} days for {len(user_ids)} users in {perf_counter() - started:.1f} s.')
+
+@click.command('generate-data')
+@click.option('--users', 'num_users', default=10, show_default=True, help='Families to create.')
+@click.option('--recipes', 'num_recipes', default=200, show_default=True, help='Recipes per family.')
+@click.option('--ingredients', 'num_ingredients', default=1000, show_default=True, help='Ingredients per family.')
+@click.option('--days', 'num_days', default=730, show_default=True,
+              help='Days of planner, log and ketone history per family, ending today.')
+@click.option('--per-recipe', 'ingredients_per_recipe', default=5, show_default=True,
+              help='Ingredients in each recipe.')
+@click.option('--prefix', default='bench', show_default=True, help='Child\'s name prefix for the new users.')
+@click.option('--password', default='bench', show_default=True, help='Password for the new users.')
+@click.option('--seed', default=0, show_default=True, help='Random seed.')
+@with_appcontext
+def generate_data(num_users, num_recipes, num_ingredients, num_days, ingredients_per_recipe, prefix, password, seed):
+    """Fill the database with synthetic families for benchmarking."""
+    migrations.upgrade()
+    started = perf_counter()
+    user_ids = synthetic.generate(
+        num_users, num_recipes, num_ingredients, num_days, ingredients_per_recipe=ingredients_per_recipe,
+        prefix=prefix, password=password, seed=seed,
+        progress=lambda done, total: click.echo(f'{done}/{total} families', err=True)
+    )
+    for uid in user_ids:
+        refresh_summaries(uid)
+    db.session.commit()
+    elapsed = perf_counter() - started
+    click.echo(f'Created {len(user_ids)} families (user ids {user_ids[0]}-{user_ids[-1]}) in {elapsed:.1f} s.'
+               if user_ids else 'Nothing to create.')
+
+@click.command('bench-routes')
+@click.option('--user', 'childsname', help='Child\'s name to benchmark as; defaults to the first bench-* user.')
+@click.option('--repeat', default=5, show_default=True, help='Requests per route.')
+@with_appcontext
+def bench_routes(childsname, repeat):
+    """Time every route and fail if any goes over its query budget."""
+    query = Users.query.filter_by(childsname=childsname) if childsname else (
+        Users.query.filter(Users.childsname.like('bench-%')).order_by(Users.id))
+    user = query.first()
+    if not user:
+        raise click.ClickException('No user to benchmark as; run flask generate-data first.')
+    user_id, childsname = user.id, user.childsname
+
+    try:
+        ctx, results = benchmark.run(current_app._get_current_object(), user_id, repeat=repeat)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Benchmarking as {childsname} ({ctx["log_rows"]} log rows), {repeat} requests per route')
+    click.echo(f'{"route":<58} {"status":>6} {"p50 ms":>8} {"p95 ms":>8} {"queries":>8} {"budget":>7} {"KB":>7}')
+
+    failed = 0
+    for r in results:
+        wall = r.stats.get('wall_ms', {})
+        size = r.stats.get('response_bytes', {}).get('p50')
+        click.echo(
+            f'{r.method + " " + r.path:<58.58} {r.statuses[-1]:>6} {wall.get("p50", 0):>8.1f} '
+            f'{wall.get("p95", 0):>8.1f} {r.stats.get("queries", {}).get("max", 0):>8g} {r.budget:>7} '
+            f'{(size or 0) / 1024:>7.1f}'
+        )
+        for failure in r.failures:
+            click.echo(f'    FAIL {r.endpoint}: {failure}', err=True)
+        failed += bool(r.failures)
+
+    if failed:
+        raise click.ClickException(f'{failed} of {len(results)} routes failed.')
+    click.echo(f'All {len(results)} routes within budget.')
+
+@click.command('load-test')
+@click.option('--config', 'configs', multiple=True, default=['sync:1', 'sync:4', 'gthread:2:4'], show_default=True,
+              help='Gunicorn worker_class:workers[:threads]; repeat to compare several.')
+@click.option('--families', default=20, show_default=True, help='Families saving at once (bench-1 upwards).')
+@click.option('--duration', default=30, show_default=True, help='Seconds to run each configuration.')
+@click.option('--prefix', default='bench', show_default=True, help='Child\'s name prefix of the generated users.')
+@click.option('--password', default='bench', show_default=True, help='Password of the generated users.')
+@with_appcontext
+def load_test(configs, families, duration, prefix, password):
+    """Load-test the app under gunicorn with concurrent families."""
+    try:
+        configs = [loadtest.parse_config(c) for c in configs]
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--config')
+
+    names = [name for (name,) in db.session.query(Users.childsname)
+             .filter(Users.childsname.like(f'{prefix}-%')).order_by(Users.id).limit(families)]
+    db.session.remove()
+    if len(names) < families:
+        raise click.ClickException(f'Only {len(names)} {prefix}-* users; run flask generate-data --users {families}.')
+
+    click.echo(f'{families} families, {duration} s per configuration')
+    click.echo(f'{"config":<14} {"step":<13} {"done":>6} {"per s":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+               f'{"errors":>7}')
+    for config in configs:
+        result = loadtest.run(config, names, duration, password=password)
+        label = f'{config.worker_class}:{config.workers}' + (f':{config.threads}' if config.threads > 1 else '')
+        for step, stats in result.steps.items():
+            click.echo(
+                f'{label:<14} {step:<13} {stats["count"]:>6} {stats["per_second"]:>7.1f} '
+                f'{stats["p50"] or 0:>8.1f} {stats["p95"] or 0:>8.1f} {stats["p99"] or 0:>8.1f} '
+                f'{stats["error_rate"]:>7.1%}'
+            )
+
+@click.command('import-ingredients')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'childsname', required=True, help='Child\'s name of the account to add them to.')
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), help='Defaults to the file extension.')
+@click.option('--type', 'default_type', help='Type for rows without one, e.g. dairy.')
+@click.option('--units', 'default_units', type=click.Choice(['g', 'ml']), help='Units for rows without them.')
+@click.option('--source', 'default_source', help='Source for rows without one.')
+@click.option('--dry-run', is_flag=True, help='Validate and report without saving.')
+@with_appcontext
+def import_ingredients_command(path, childsname, fmt, default_type, default_units, default_source, dry_run):
+    """Bulk import ingredients from a CSV or JSON nutrition table."""
+    user = Users.query.filter_by(childsname=childsname).first()
+    if not user:
+        raise click.ClickException(f'No user called {childsname}.')
+    fmt = fmt or format_for(path)
+    if not fmt:
+        raise click.BadParameter('Cannot tell the format from the file name.', param_hint='--format')
+
+    started = perf_counter()
+    with open(path, 'rb') as f:
+        try:
+            report = import_ingredients(
+                user.id, f, fmt, defaults={'type': default_type, 'units': default_units, 'source': default_source},
+                dry_run=dry_run)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    elapsed = perf_counter() - started
+
+    for row_number, name, message in report.errors:
+        click.echo(f'Row {row_number} ({name}): {message}', err=True)
+    click.echo(
+        f'{report.rows} rows: {report.inserted} {"would be " if dry_run else ""}imported, '
+        f'{report.duplicates} already present, {report.invalid} invalid ({elapsed:.1f} s)'
+        f'{" (dry run)" if dry_run else ""}.'
+    )
+
+@click.command('import-readings')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'childsname', required=True, help='Child\'s name of the account to add them to.')
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), help='Defaults to the file extension.')
+@with_appcontext
+def import_readings_command(path, childsname, fmt):
+    """Bulk import ketone and glucose readings from a meter's CSV or JSON export."""
+    user = Users.query.filter_by(childsname=childsname).first()
+    if not user:
+        raise click.ClickException(f'No user called {childsname}.')
+    fmt = fmt or format_for(path)
+    if not fmt:
+        raise click.BadParameter('Cannot tell the format from the file name.', param_hint='--format')
+
+    started = perf_counter()
+    with open(path, 'rb') as f:
+        try:
+            report = import_readings(user.id, f, fmt)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    elapsed = perf_counter() - started
+
+    for row_number, message in report.errors:
+        click.echo(f'Row {row_number}: {message}', err=True)
+    click.echo(
+        f'{report.rows} rows: {report.inserted} inserted, {report.updated} updated, '
+        f'{report.skipped} skipped, {report.invalid} invalid ({elapsed:.1f} s).'
+    )
+
+def register_commands(app):
+    app.cli.add_command(db_upgrade)
+    app.cli.add_command(recompute_recipes_command)
+    app.cli.add_command(backfill_summaries)
+    app.cli.add_command(generate_data)
+    app.cli.add_command(bench_routes)
+    app.cli.add_command(load_test)
+    app.cli.add_command(import_ingredients_command)
+    app.cli.add_command(import_readings_command)
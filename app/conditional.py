@@ -0,0 +1,86 @@
+# Conditional GET for pages that only change when the user's own data does.
+#
+# A page's ETag is worked out before the view runs, from values that are already in memory: the
+# release, the endpoint, and the user's id and data_version (from current_user's snapshot, see
+# cache.load_user, and bumped by every commit that changes what these pages show). When the browser's
+# If-None-Match matches, the view is skipped and a bare 304 goes back: no row queries, no rendering.
+#
+# Pages with a form also fold in the session's CSRF secret and the current half-hour, so a page that
+# is revalidated never carries a CSRF token older than WTF_CSRF_TIME_LIMIT allows. Pending flash
+# messages are shown by the next render, so while there are any the page is rendered and not stored.
+
+import hashlib
+import os
+import time
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+
+FORM_PAGE_BUCKET = 30 * 60
+
+def _release_token(app):
+    # RELEASE (or Heroku's release version) when set, else the modification times of the app's code and
+    # templates, so a deploy that changes a page never gets a 304 for the old one
+    release = app.config.get('RELEASE')
+    if release:
+        return release
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(app.root_path):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for name in sorted(files):
+            if name.endswith(('.py', '.html', '.css')):
+                path = os.path.join(root, name)
+                digest.update(f'{path}:{os.stat(path).st_mtime_ns}'.encode())
+    return digest.hexdigest()[:12]
+
+def init_app(app):
+    app.extensions['release_token'] = _release_token(app)
+
+def _etag(*parts):
+    key = ':'.join(str(p) for p in (current_app.extensions['release_token'], request.endpoint, *parts))
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+def _page_etag(form):
+    parts = [current_user.id, current_user.data_version]
+    if form:
+        csrf_secret = session.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'), '')
+        parts += [hashlib.sha1(csrf_secret.encode()).hexdigest()[:8], int(time.time() // FORM_PAGE_BUCKET)]
+    return _etag(*parts)
+
+def _respond(view, args, kwargs, etag, cache_control):
+    if session.get('_flashes'):
+        response = make_response(view(*args, **kwargs))
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Cookie')
+    return response
+
+def conditional_page(form=False):
+    # For GETs of pages built only from the user's own data; form=True for pages with a CSRF token
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+            return _respond(view, args, kwargs, _page_etag(form), 'private, no-cache')
+        return wrapped
+    return decorator
+
+def static_page(view):
+    # For pages that are the same for every user until the next release; browsers reuse them for
+    # STATIC_PAGE_MAX_AGE seconds without asking
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        max_age = current_app.config['STATIC_PAGE_MAX_AGE']
+        return _respond(view, args, kwargs, _etag(), f'private, max-age={max_age}')
+    return wrapped
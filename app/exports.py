@@ -0,0 +1,135 @@
+# CSV/JSON exports of a user's log, ketone readings, planner and recipes.
+#
+# Each export is a single SELECT over the user's rows (an owned() query's statement) run with yield_per, which uses a server-side cursor on Postgres, and
+# the rows are encoded and sent a batch at a time, so years of data never sit in memory at once and
+# the first bytes go out as soon as the first batch is read.
+
+import csv
+import io
+import json
+from datetime import date, time
+
+from . import db
+from .models import Ingredient, Recipe, RecipeIngredient, PlannerEntry, LogEntry, KetoneLogEntry
+from .queries import owned
+
+BATCH_SIZE = 500
+
+def _eaten(column):
+    return column * LogEntry.percent_eaten / 100
+
+def _log_export(user_id, start, end):
+    columns = [
+        LogEntry.date, LogEntry.slot,
+        Recipe.name.label('recipe'), LogEntry.free_text, LogEntry.percent_eaten, LogEntry.notes,
+        Recipe.total_fat.label('recipe_fat'), Recipe.total_carbs.label('recipe_carbs'),
+        Recipe.total_protein.label('recipe_protein'), Recipe.total_calories.label('recipe_calories'),
+        Recipe.ratio.label('recipe_ratio'),
+        _eaten(Recipe.total_fat).label('eaten_fat'), _eaten(Recipe.total_carbs).label('eaten_carbs'),
+        _eaten(Recipe.total_protein).label('eaten_protein'), _eaten(Recipe.total_calories).label('eaten_calories'),
+    ]
+    # Custom meals are logged without a recipe, so the recipe is an outer join
+    stmt = (
+        owned(LogEntry, user_id)
+        .with_entities(*columns)
+        .outerjoin(Recipe, Recipe.id == LogEntry.recipe_id)
+        .order_by(LogEntry.date, LogEntry.slot)
+        .statement
+    )
+    return _in_range(stmt, LogEntry.date, start, end)
+
+def _ketone_export(user_id, start, end):
+    stmt = (
+        owned(KetoneLogEntry, user_id)
+        .with_entities(KetoneLogEntry.date, KetoneLogEntry.time, KetoneLogEntry.ketone_level,
+                       KetoneLogEntry.glucose_level)
+        .order_by(KetoneLogEntry.date, KetoneLogEntry.time)
+        .statement
+    )
+    return _in_range(stmt, KetoneLogEntry.date, start, end)
+
+def _planner_export(user_id, start, end):
+    stmt = (
+        owned(PlannerEntry, user_id)
+        .with_entities(PlannerEntry.date, PlannerEntry.slot, Recipe.name.label('recipe'), PlannerEntry.free_text,
+                       PlannerEntry.notes)
+        .outerjoin(Recipe, Recipe.id == PlannerEntry.recipe_id)
+        .order_by(PlannerEntry.date, PlannerEntry.slot)
+        .statement
+    )
+    return _in_range(stmt, PlannerEntry.date, start, end)
+
+def _recipe_export(user_id, start, end):
+    # One row per recipe ingredient; recipes have no date, so the range is ignored
+    return (
+        owned(Recipe, user_id)
+        .with_entities(
+            Recipe.id.label('recipe_id'), Recipe.name.label('recipe'), Recipe.author, Recipe.meal_type,
+            Recipe.total_fat, Recipe.total_carbs, Recipe.total_protein, Recipe.total_calories, Recipe.ratio,
+            Ingredient.name.label('ingredient'), Ingredient.units, RecipeIngredient.amount,
+            RecipeIngredient.fat, RecipeIngredient.carbs, RecipeIngredient.protein, RecipeIngredient.calories,
+        )
+        .outerjoin(RecipeIngredient, RecipeIngredient.recipe_id == Recipe.id)
+        .outerjoin(Ingredient, Ingredient.id == RecipeIngredient.ingredient_id)
+        .order_by(Recipe.name, Recipe.id, RecipeIngredient.id)
+        .statement
+    )
+
+def _in_range(stmt, column, start, end):
+    if start:
+        stmt = stmt.where(column >= start)
+    if end:
+        stmt = stmt.where(column <= end)
+    return stmt
+
+EXPORTS = {
+    'log': _log_export,
+    'ketones': _ketone_export,
+    'planner': _planner_export,
+    'recipes': _recipe_export,
+}
+FORMATS = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+}
+
+def _json_value(value):
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if value is not None and not isinstance(value, (int, float, str, bool)):
+        return float(value)  # Numeric columns come back as Decimal
+    return value
+
+def _batches(stmt):
+    result = db.session.execute(stmt.execution_options(yield_per=BATCH_SIZE))
+    yield list(result.keys())
+    yield from result.partitions()
+
+def _csv_chunks(batches):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(next(batches))
+    for rows in batches:
+        writer.writerows(rows)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue()
+
+def _json_chunks(batches):
+    keys = next(batches)
+    yield '['
+    first = True
+    for rows in batches:
+        chunk = ','.join(json.dumps({k: _json_value(v) for k, v in zip(keys, row)}) for row in rows)
+        yield chunk if first else ',' + chunk
+        first = False
+    yield ']'
+
+def export_chunks(kind, fmt, user_id, start=None, end=None):
+    # Generator of text chunks; kind and fmt must be keys of EXPORTS and FORMATS
+    batches = _batches(EXPORTS[kind](user_id, start, end))
+    chunks = _csv_chunks(batches) if fmt == 'csv' else _json_chunks(batches)
+    for chunk in chunks:
+        if chunk:
+            yield chunk
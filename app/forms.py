@@ -1,35 +1,103 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired, FileAllowed
 from wtforms import (StringField, TextAreaField, FloatField, SelectField, FieldList, FormField, SubmitField, 
-    DecimalField, IntegerField, PasswordField, EmailField, RadioField, TimeField, HiddenField)
-from wtforms.validators import DataRequired, NumberRange, Optional, Email, EqualTo, ValidationError
+    DecimalField, IntegerField, PasswordField, EmailField, RadioField, TimeField, HiddenField, BooleanField)
+from wtforms.validators import (DataRequired, InputRequired, Length, NumberRange, Optional, Email, EqualTo,
+    ValidationError)
 
 from .models import Ingredient, Users
+from .queries import owned
+
+class IngredientSearchField(HiddenField):
+    # Id of an ingredient picked with the recipe pages' search box. Only the chosen ingredient is
+    # rendered; the valid ids and their labels come from set_ingredient_choices.
+    def __init__(self, label=None, validators=None, **kwargs):
+        super().__init__(label, validators, **kwargs)
+        self.labels = {}
+
+    def process_formdata(self, valuelist):
+        self.data = None
+        if valuelist and valuelist[0].strip():
+            try:
+                self.data = int(valuelist[0])
+            except ValueError:
+                raise ValueError('Not a valid ingredient.')
+
+    def pre_validate(self, form):
+        if self.data not in self.labels:
+            raise ValidationError('Please choose an ingredient from the list.')
+
+    @property
+    def selected_label(self):
+        return self.labels.get(self.data, '')
 
 class RecipeIngredientForm(FlaskForm):
-    ingredient_id = SelectField('Ingredient', coerce=int, validators=[DataRequired()])
+    ingredient_id = IngredientSearchField('Ingredient')
     amount = FloatField('Amount (g or ml)', validators=[DataRequired(), NumberRange(min=0.01)])
 
+INGREDIENT_TYPES = [
+    ('', 'Choose...'),
+    ('vegetables', 'Vegetables'),
+    ('fruit', 'Fruit'),
+    ('nuts_seeds', 'Nuts and seeds'),
+    ('dairy', 'Dairy'),
+    ('fats_oils', 'Fats and oils'),
+    ('carbohydrates', 'Carbohydrates'),
+    ('meats_fishes', 'Meats and fishes')
+]
+
 class IngredientForm(FlaskForm):
-    name = StringField('Name', validators=[DataRequired()])
-    source = StringField('Source', validators=[Optional()])
-    type = SelectField('Type', choices=[
-        ('', 'Choose...'),
-        ('vegetables', 'Vegetables'),
-        ('fruit', 'Fruit'),
-        ('nuts_seeds', 'Nuts and seeds'),
-        ('dairy', 'Dairy'),
-        ('fats_oils', 'Fats and oils'),
-        ('carbohydrates', 'Carbohydrates'),
-        ('meats_fishes', 'Meats and fishes')
-    ], validators=[DataRequired()])
+    # Lengths as in the ingredient table, so an imported row that is too long is reported, not inserted
+    name = StringField('Name', validators=[DataRequired(), Length(max=80)])
+    source = StringField('Source', validators=[Optional(), Length(max=150)])
+    type = SelectField('Type', choices=INGREDIENT_TYPES, validators=[DataRequired()])
     units = RadioField('Units', choices=[
         ('g', 'Grams (g)'),
         ('ml', 'Milliliters (ml)')
     ], validators=[DataRequired()])
-    percent_fat = FloatField('Fat %', validators=[DataRequired()])
-    percent_carbs = FloatField('Carbohydrate %', validators=[DataRequired()])
-    percent_protein = FloatField('Protein %', validators=[DataRequired()])
-    total_calories = FloatField('Calories per 100g or ml', validators=[DataRequired()], render_kw={'readonly': True})
+    # InputRequired rather than DataRequired so that 0 is accepted
+    percent_fat = FloatField('Fat %', validators=[InputRequired(), NumberRange(min=0, max=100)])
+    percent_carbs = FloatField('Carbohydrate %', validators=[InputRequired(), NumberRange(min=0, max=100)])
+    percent_protein = FloatField('Protein %', validators=[InputRequired(), NumberRange(min=0, max=100)])
+    total_calories = FloatField('Calories per 100g or ml', validators=[InputRequired()], render_kw={'readonly': True})
+
+    # Set with set_owner; names only have to be unique within one user's ingredients
+    owner_id = None
+    editing_id = None
+
+    def set_owner(self, user_id, ingredient_id=None):
+        self.owner_id = user_id
+        self.editing_id = ingredient_id
+
+    def allow_blank_macros(self):
+        # Unmeasured ingredients (the fruit and vegetable groups) have no percentages to enter
+        for field in (self.percent_fat, self.percent_carbs, self.percent_protein, self.total_calories):
+            field.validators = [Optional()] + [v for v in field.validators if not isinstance(v, InputRequired)]
+            field.flags.required = False
+
+    def validate_name(self, name):
+        if self.owner_id is None:
+            return
+        query = owned(Ingredient, self.owner_id).filter(Ingredient.name == name.data.strip())
+        if self.editing_id is not None:
+            query = query.filter(Ingredient.id != self.editing_id)
+        if query.first():
+            raise ValidationError('You already have an ingredient with this name.')
+
+class IngredientImportForm(FlaskForm):
+    file = FileField('Nutrition table (CSV or JSON)', validators=[
+        FileRequired(), FileAllowed(['csv', 'json', 'ndjson', 'jsonl'], 'Please upload a CSV or JSON file.')])
+    default_type = SelectField('Type for rows without one', choices=INGREDIENT_TYPES,
+                               validators=[Optional()])
+    default_units = SelectField('Units for rows without them', choices=[('g', 'Grams (g)'), ('ml', 'Milliliters (ml)')])
+    default_source = StringField('Source for rows without one', validators=[Optional()])
+    dry_run = BooleanField('Dry run (check the file without saving)')
+    submit = SubmitField('Import')
+
+class ReadingsImportForm(FlaskForm):
+    file = FileField('Meter export (CSV or JSON)', validators=[
+        FileRequired(), FileAllowed(['csv', 'json', 'ndjson', 'jsonl'], 'Please upload a CSV or JSON file.')])
+    submit = SubmitField('Import')
 
 class RecipeForm(FlaskForm):
     name = StringField('Recipe Name', validators=[DataRequired()])
@@ -50,14 +118,10 @@ class RecipeForm(FlaskForm):
     ingredients = FieldList(FormField(RecipeIngredientForm), min_entries=1, max_entries=20)
     submit = SubmitField('Save Recipe')
     
-    def set_ingredient_choices(self):
-        ingredients = Ingredient.query.filter_by(unmeasured_ingredient=False).order_by(Ingredient.name).all()
-        choices = [
-            (ing.id, f"{ing.name} ({ing.source})" if ing.source else ing.name)
-            for ing in ingredients
-        ]
+    def set_ingredient_choices(self, labels):
+        # labels: ingredient id -> label
         for ingredient_form in self.ingredients:
-            ingredient_form.ingredient_id.choices = choices
+            ingredient_form.ingredient_id.labels = labels
 
 class CalculatedRecipeForm(FlaskForm):
     name = StringField('Recipe Name', validators=[DataRequired()])
@@ -83,10 +147,10 @@ class CalculatedRecipeForm(FlaskForm):
     
     submit = SubmitField('Create Recipe')
 
-    def set_ingredient_choices(self):
-        choices = [(ing.id, ing.name) for ing in Ingredient.query.order_by(Ingredient.name).all()]
+    def set_ingredient_choices(self, labels):
+        # labels: ingredient id -> label
         for entry in self.ingredients.entries:
-            entry.form.ingredient_id.choices = choices
+            entry.form.ingredient_id.labels = labels
 
 class TargetForm(FlaskForm):
     ratio = DecimalField('Ratio', places=2, validators=[DataRequired()])
@@ -130,7 +194,7 @@ class RegistrationForm(FlaskForm):
         
 class PlannerSlotForm(FlaskForm):
     recipe_id = SelectField('Recipe', coerce=int, validators=[Optional()])
-    free_text = StringField('Or enter custom', validators=[Optional()])
+    free_text = StringField('Or enter custom', validators=[Optional(), Length(max=200)])
     notes = TextAreaField('Notes', render_kw={"rows":2, "cols":30}, validators=[Optional()])
 
 class PlannerForm(FlaskForm):
@@ -138,8 +202,9 @@ class PlannerForm(FlaskForm):
 
 class LogSlotForm(FlaskForm):
     recipe_id = SelectField('Recipe', coerce=int)
-    free_text = StringField('Custom meal')
-    percent_eaten = FloatField('% eaten', default=100)
+    free_text = StringField('Custom meal', validators=[Length(max=200)])
+    # A blank percentage is saved as 100
+    percent_eaten = FloatField('% eaten', default=100, validators=[Optional(), NumberRange(min=0, max=100)])
     notes = TextAreaField('Notes', render_kw={"rows":2, "cols":30})
 
 class KetoneEntryForm(FlaskForm):
@@ -0,0 +1,195 @@
+# Bulk ingredient import from nutrition tables (CSV, a JSON array, or newline-delimited JSON).
+#
+# The file is read one row at a time. Each row is checked with IngredientForm, the same validation as
+# the add ingredient page, with total_calories worked out as the page's script does
+# (9 kcal/g fat, 4 kcal/g carbs and protein). Rows are deduplicated on (user, name) against the file
+# and the database, and inserted as executemany batches. The whole file is one transaction, and a
+# dry run does everything except the inserts.
+
+import csv
+import io
+import json
+from dataclasses import dataclass, field
+
+from sqlalchemy import insert
+from werkzeug.datastructures import MultiDict
+
+from . import db
+from .cache import bump_data_version
+from .forms import IngredientForm
+from .models import Ingredient
+from .queries import owned
+
+BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+
+# Column headings accepted for each IngredientForm field, compared case-insensitively
+COLUMN_ALIASES = {
+    'name': ('name', 'food', 'food name', 'description', 'ingredient'),
+    'source': ('source', 'brand', 'shop'),
+    'type': ('type', 'group', 'category'),
+    'units': ('units', 'unit'),
+    'percent_fat': ('percent_fat', 'fat', 'fat %', 'fat (g)', 'total fat'),
+    'percent_carbs': ('percent_carbs', 'carbs', 'carbs %', 'carbohydrate', 'carbohydrate (g)', 'carbohydrates'),
+    'percent_protein': ('percent_protein', 'protein', 'protein %', 'protein (g)'),
+}
+FORMATS = ('csv', 'json')
+
+@dataclass
+class ImportReport:
+    dry_run: bool = False
+    rows: int = 0
+    inserted: int = 0
+    duplicates: int = 0
+    invalid: int = 0
+    errors: list = field(default_factory=list)  # (row number, name, message)
+
+    def add_error(self, row_number, name, message):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((row_number, name, message))
+
+def format_for(filename):
+    # csv for .csv files, json for .json/.ndjson/.jsonl, else None
+    ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if ext == 'csv':
+        return 'csv'
+    if ext in ('json', 'ndjson', 'jsonl'):
+        return 'json'
+    return None
+
+def _lines(first, text):
+    # Lines of a text stream whose first chunk has already been read into first
+    lines = first.split('\n')
+    carry = lines.pop()
+    yield from lines
+    for line in text:
+        yield carry + line
+        carry = ''
+    if carry:
+        yield carry
+
+def _json_records(text, chunk_size=64 * 1024):
+    # A top-level array is decoded one element at a time; anything else is read as one object per line
+    buffer = text.read(chunk_size)
+    if not buffer.lstrip().startswith('['):
+        yield from (json.loads(line) for line in _lines(buffer, text) if line.strip())
+        return
+
+    decoder = json.JSONDecoder()
+    buffer = buffer.lstrip()[1:]
+    eof = False
+    while True:
+        buffer = buffer.lstrip().lstrip(',').lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            # Most likely the element runs on into the next chunk
+            if eof:
+                raise
+            more = text.read(chunk_size)
+            eof = not more
+            buffer += more
+            continue
+        yield record
+        buffer = buffer[end:]
+
+def read_records(stream, fmt):
+    # Dicts from a binary stream, in file order
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    records = csv.DictReader(text) if fmt == 'csv' else _json_records(text)
+    for record in records:
+        if not isinstance(record, dict):
+            raise ValueError('Each JSON record must be an object.')
+        yield record
+
+def _normalise(record, defaults):
+    # Map the record's headings onto IngredientForm fields, falling back to the defaults
+    lowered = {str(k).strip().lower(): v for k, v in record.items() if k is not None}
+    data = {}
+    for fld, aliases in COLUMN_ALIASES.items():
+        value = next((lowered[a] for a in aliases if lowered.get(a) not in (None, '')), defaults.get(fld))
+        if value is not None:
+            data[fld] = str(value).strip()
+    return data
+
+def _validated(data):
+    # (IngredientForm, None) for a valid row, or (None, the form errors as one message)
+    try:
+        fat, carbs, protein = (float(data.get(f, '')) for f in ('percent_fat', 'percent_carbs', 'percent_protein'))
+        data['total_calories'] = str(round(9 * fat + 4 * carbs + 4 * protein, 1))
+    except ValueError:
+        pass  # left for the form to report against the field
+    form = IngredientForm(formdata=MultiDict(data), meta={'csrf': False})
+    if not form.validate():
+        return None, '; '.join(f'{name}: {" ".join(errors)}' for name, errors in form.errors.items())
+    return form, None
+
+def _flush(user_id, batch, report):
+    # Drop rows the user already has an ingredient of that name for, then insert the rest in one executemany
+    taken = {
+        name for name, in owned(Ingredient, user_id)
+        .with_entities(Ingredient.name)
+        .filter(Ingredient.name.in_([row['name'] for row in batch]))
+    }
+    rows = []
+    for row in batch:
+        if row['name'] in taken:
+            report.duplicates += 1
+        else:
+            rows.append(row)
+    if rows and not report.dry_run:
+        db.session.execute(insert(Ingredient), rows)
+    report.inserted += len(rows)
+
+def import_ingredients(user_id, stream, fmt, defaults=None, dry_run=False):
+    # Returns an ImportReport; commits unless dry_run, and raises ValueError for an unreadable file
+    defaults = {k: v for k, v in (defaults or {}).items() if v}
+    report = ImportReport(dry_run=dry_run)
+    seen = set()
+    batch = []
+
+    try:
+        for row_number, record in enumerate(read_records(stream, fmt), start=1):
+            report.rows += 1
+            data = _normalise(record, defaults)
+            form, error = _validated(data)
+            if error:
+                report.add_error(row_number, data.get('name', ''), error)
+                continue
+
+            name = form.name.data.strip()
+            if name in seen:
+                report.duplicates += 1
+                continue
+            seen.add(name)
+
+            batch.append({
+                'user_id': user_id,
+                'name': name,
+                'source': form.source.data or None,
+                'type': form.type.data,
+                'units': form.units.data,
+                'percent_fat': form.percent_fat.data,
+                'percent_carbs': form.percent_carbs.data,
+                'percent_protein': form.percent_protein.data,
+                'total_calories': form.total_calories.data,
+                'unmeasured_ingredient': False,
+            })
+            if len(batch) >= BATCH_SIZE:
+                _flush(user_id, batch, report)
+                batch = []
+        if batch:
+            _flush(user_id, batch, report)
+    except (UnicodeDecodeError, csv.Error, ValueError) as e:
+        db.session.rollback()
+        raise ValueError(f'Could not read the file: {e}') from e
+
+    if dry_run or not report.inserted:
+        db.session.rollback()
+    else:
+        bump_data_version(user_id)
+        db.session.commit()
+    return report
@@ -0,0 +1,147 @@
+# Per-request timing and SQL query counts.
+#
+# Every request records its wall time, the number of SQL statements it ran and their total time,
+# the time spent rendering templates, the size of the HTML they rendered and the response size. Each request is logged as one
+# key=value line at INFO, and the last METRICS_WINDOW samples per endpoint are kept in memory
+# so /metrics can report p50/p95 for each worker.
+
+import time
+from collections import defaultdict, deque
+from threading import Lock
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+FIELDS = ('wall_ms', 'queries', 'sql_ms', 'render_ms', 'template_bytes', 'response_bytes')
+
+class RequestMetrics:
+    def __init__(self, window=500):
+        self.window = window
+        self._samples = defaultdict(lambda: deque(maxlen=self.window))
+        self._counts = defaultdict(int)
+        self._lock = Lock()
+
+    def record(self, endpoint, sample):
+        with self._lock:
+            self._samples[endpoint].append(sample)
+            self._counts[endpoint] += 1
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+
+    def snapshot(self):
+        with self._lock:
+            samples = {endpoint: list(s) for endpoint, s in self._samples.items()}
+            counts = dict(self._counts)
+
+        report = {}
+        for endpoint, rows in sorted(samples.items()):
+            stats = {'requests': counts[endpoint], 'window': len(rows)}
+            for field in FIELDS:
+                values = sorted(row[field] for row in rows if row[field] is not None)
+                if values:
+                    stats[field] = {
+                        'p50': percentile(values, 50),
+                        'p95': percentile(values, 95),
+                        'max': round(values[-1], 2),
+                    }
+            report[endpoint] = stats
+        return report
+
+def percentile(values, pct):
+    # Nearest-rank percentile over an already sorted list
+    rank = max(0, -(-len(values) * pct // 100) - 1)
+    return round(values[int(rank)], 2)
+
+request_metrics = RequestMetrics()
+
+# SQLAlchemy events fire for every engine, so the listeners are attached once at import time and
+# only count statements run while a request is being handled
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_queries' in g:
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if not started or not has_request_context() or 'sql_queries' not in g:
+        return
+    g.sql_queries += 1
+    g.sql_seconds += time.perf_counter() - started.pop()
+
+def _before_render(app, template, context, **extra):
+    if 'render_started' in g:
+        g.render_started.append(time.perf_counter())
+
+def _after_render(app, template, context, **extra):
+    if g.get('render_started'):
+        g.render_seconds += time.perf_counter() - g.render_started.pop()
+
+class MeasuredTemplate(Template):
+    # The signals only carry the template and its context, so the rendered size is taken here. Every
+    # render_template call counts, page cache fragments included; includes count as part of their parent.
+    def render(self, *args, **kwargs):
+        html = super().render(*args, **kwargs)
+        if has_request_context() and 'template_bytes' in g:
+            g.template_bytes += len(html.encode())
+        return html
+
+def init_app(app):
+    request_metrics.window = app.config['METRICS_WINDOW']
+    app.logger.setLevel(app.config['LOG_LEVEL'])
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    app.jinja_env.template_class = MeasuredTemplate
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+        g.render_started = []
+        g.render_seconds = 0.0
+        g.template_bytes = 0
+
+    @app.after_request
+    def record_request(response):
+        if 'request_started' not in g:
+            return response
+
+        endpoint = request.endpoint or 'unmatched'
+        method = request.method
+        counters = g._get_current_object()
+
+        def record():
+            sample = {
+                'wall_ms': (time.perf_counter() - counters.request_started) * 1000,
+                'queries': counters.sql_queries,
+                'sql_ms': counters.sql_seconds * 1000,
+                'render_ms': counters.render_seconds * 1000,
+                'template_bytes': counters.template_bytes,
+                # Streamed bodies are sent by the server rather than measured here
+                'response_bytes': None if response.is_streamed else response.calculate_content_length(),
+            }
+            if endpoint != 'static':
+                request_metrics.record(endpoint, sample)
+
+            app.logger.info(
+                'request method=%s endpoint=%s status=%s wall_ms=%.1f queries=%d sql_ms=%.1f render_ms=%.1f '
+                'template_bytes=%d response_bytes=%s',
+                method, endpoint, response.status_code, sample['wall_ms'], sample['queries'],
+                sample['sql_ms'], sample['render_ms'], sample['template_bytes'],
+                sample['response_bytes'] if sample['response_bytes'] is not None else '-'
+            )
+
+        # A streamed body (the exports) runs its queries after this hook, inside the same request, so
+        # it is recorded once the server has sent it and closed the response
+        if response.is_streamed:
+            response.call_on_close(record)
+        else:
+            record()
+        return response
@@ -0,0 +1,278 @@
+# Concurrent load test against the app running under gunicorn.
+#
+# For each worker configuration a gunicorn server is started on a local port against the configured
+# database, and one thread per family (the bench-N users from flask generate-data) repeats the
+# caregiver flow until the time is up: log in, save the planner, save the log with a ketone reading,
+# browse recipes. Pages are fetched and their forms submitted the way a browser would, CSRF token
+# included. Standard library only, so it runs wherever the app does.
+
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, namedtuple
+from datetime import date
+from html.parser import HTMLParser
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, build_opener
+
+from .instrumentation import percentile
+
+STEPS = ('login', 'planner_save', 'log_save', 'recipes')
+
+WorkerConfig = namedtuple('WorkerConfig', 'worker_class workers threads')
+LoadResult = namedtuple('LoadResult', 'config elapsed steps')
+
+def parse_config(value):
+    # class:workers[:threads], e.g. sync:4 or gthread:2:8
+    parts = value.split(':')
+    if len(parts) not in (2, 3) or not all(p.isdigit() for p in parts[1:]):
+        raise ValueError(f'Expected class:workers[:threads], got {value!r}')
+    return WorkerConfig(parts[0], int(parts[1]), int(parts[2]) if len(parts) == 3 else 1)
+
+def _is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+class _FormScraper(HTMLParser):
+    # Collects the fields a browser would submit from the first <form method="post"> on a page
+    def __init__(self):
+        super().__init__()
+        self.fields = []
+        self.options = defaultdict(list)
+        self._in_form = False
+        self._select = None
+        self._selected = None
+        self._textarea = None
+        self._choices_script = False
+        self.shared_choices = ''
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'script' and attrs.get('id') == 'recipe-choices':
+            self._choices_script = True
+        if tag == 'form' and attrs.get('method', '').lower() == 'post' and not self.fields:
+            self._in_form = True
+        if not self._in_form:
+            return
+        name = attrs.get('name')
+        if tag == 'input' and name and attrs.get('type') not in ('submit', 'button', 'checkbox', 'radio'):
+            value = attrs.get('value') or ''
+            if attrs.get('type') == 'number' and not _is_number(value):
+                value = ''  # browsers submit an unparseable number input as empty
+            self.fields.append([name, value])
+        elif tag == 'input' and name and attrs.get('type') in ('checkbox', 'radio') and 'checked' in attrs:
+            self.fields.append([name, attrs.get('value') or 'y'])
+        elif tag == 'select' and name:
+            self._select, self._selected = name, None
+        elif tag == 'option' and self._select:
+            value = attrs.get('value', '')
+            self.options[self._select].append(value)
+            if 'selected' in attrs or self._selected is None:
+                self._selected = value
+        elif tag == 'textarea' and name:
+            self._textarea = [name, '']
+
+    def handle_data(self, data):
+        if self._choices_script:
+            self.shared_choices += data
+        if self._textarea:
+            self._textarea[1] += data
+
+    def handle_endtag(self, tag):
+        if tag == 'script':
+            self._choices_script = False
+        if tag == 'form' and self._in_form:
+            self._in_form = False
+        elif tag == 'select' and self._select:
+            self.fields.append([self._select, self._selected or ''])
+            self._select = None
+        elif tag == 'textarea' and self._textarea:
+            self.fields.append(self._textarea)
+            self._textarea = None
+
+def scrape_form(html):
+    scraper = _FormScraper()
+    scraper.feed(html)
+    if scraper.shared_choices:
+        # Compact planner/log pages send the recipe options once, for the script to add to each dropdown
+        values = [str(value) for value, _ in json.loads(scraper.shared_choices)]
+        for name, _ in scraper.fields:
+            if name.endswith('-recipe_id'):
+                scraper.options[name] = values
+    return scraper.fields, scraper.options
+
+class _NoRedirect(HTTPRedirectHandler):
+    # Time each request on its own; a 302 after a save counts as success
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+class Family:
+    def __init__(self, base_url, childsname, password, recorder, rnd):
+        self.base_url = base_url
+        self.childsname = childsname
+        self.password = password
+        self.recorder = recorder
+        self.rnd = rnd
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), _NoRedirect())
+
+    def _request(self, path, fields=None):
+        data = urlencode(fields).encode() if fields is not None else None
+        try:
+            with self.opener.open(self.base_url + path, data=data, timeout=60) as response:
+                return response.status, response.read().decode()
+        except HTTPError as e:
+            return e.code, e.read().decode(errors='replace')
+
+    def _step(self, name, *requests):
+        # A step is one or more requests; its latency is the sum. Any 4xx/5xx fails it, as does a form
+        # post that re-renders the page (validation error) instead of redirecting
+        started = time.perf_counter()
+        ok = True
+        body = ''
+        try:
+            for path, fields in requests:
+                fields = fields(body) if callable(fields) else fields
+                status, body = self._request(path, fields)
+                if status >= 400 or (fields is not None and status not in (301, 302, 303)):
+                    ok = False
+                    break
+        except (URLError, OSError, ValueError):
+            ok = False
+        self.recorder.record(name, time.perf_counter() - started, ok)
+        return ok
+
+    def _login_fields(self, html):
+        fields, _ = scrape_form(html)
+        data = dict(fields)
+        data.update(childsname=self.childsname, password=self.password)
+        return data
+
+    def _planner_fields(self, html):
+        fields, options = scrape_form(html)
+        for field in fields:
+            if field[0].endswith('-recipe_id') and options[field[0]]:
+                field[1] = self.rnd.choice([v for v in options[field[0]] if v not in ('0', '-1')] or ['0'])
+        return [tuple(field) for field in fields]
+
+    def _log_fields(self, html):
+        fields = self._planner_fields(html)
+        # A new ketone reading for today, numbered after the rows already on the page
+        indexes = [int(m) for m in re.findall(r'ketone_entries-(\d+)-', ' '.join(n for n, _ in fields))]
+        i = max(indexes, default=-1) + 1
+        fields += [
+            (f'ketone_entries-{i}-date', date.today().isoformat()),
+            (f'ketone_entries-{i}-time', f'{self.rnd.randint(6, 21):02d}:{self.rnd.randint(0, 59):02d}'),
+            (f'ketone_entries-{i}-ketone_level', f'{self.rnd.uniform(1.5, 5.5):.1f}'),
+        ]
+        return fields
+
+    def run_once(self):
+        if not self._step('login', ('/login', None), ('/login', self._login_fields)):
+            return
+        self._step('planner_save', ('/planner', None), ('/planner', self._planner_fields))
+        self._step('log_save', ('/log', None), ('/log', self._log_fields))
+        self._step('recipes', ('/recipes', None))
+        self._request('/logout')
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, step, seconds, ok):
+        with self._lock:
+            self.latencies[step].append(seconds * 1000)
+            if not ok:
+                self.errors[step] += 1
+
+    def summary(self, elapsed):
+        steps = {}
+        for step in STEPS:
+            values = sorted(self.latencies.get(step, []))
+            steps[step] = {
+                'count': len(values),
+                'per_second': len(values) / elapsed if elapsed else 0.0,
+                'p50': percentile(values, 50) if values else None,
+                'p95': percentile(values, 95) if values else None,
+                'p99': percentile(values, 99) if values else None,
+                'error_rate': self.errors.get(step, 0) / len(values) if values else 0.0,
+            }
+        return steps
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def start_gunicorn(config, port, log_file):
+    cmd = [
+        sys.executable, '-m', 'gunicorn', 'run:app',
+        '--bind', f'127.0.0.1:{port}',
+        '--workers', str(config.workers),
+        '--worker-class', config.worker_class,
+        '--threads', str(config.threads),
+        '--log-level', 'warning',
+    ]
+    # Per-request INFO lines would otherwise flood the log file
+    env = {**os.environ, 'LOG_LEVEL': os.environ.get('LOADTEST_LOG_LEVEL', 'WARNING')}
+    return subprocess.Popen(cmd, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+def run(config, families, duration, password='bench', seed=0):
+    # families: child's names to log in as, one thread each
+    port = _free_port()
+    with tempfile.NamedTemporaryFile('w+', prefix='keto-loadtest-', suffix='.log', delete=False) as log_file:
+        server = start_gunicorn(config, port, log_file)
+    try:
+        if not _wait_for_port(port, server):
+            raise RuntimeError(f'gunicorn did not start for {config}; see {log_file.name}')
+
+        recorder = Recorder()
+        deadline = time.monotonic() + duration
+
+        def family_loop(childsname, family_seed):
+            family = Family(f'http://127.0.0.1:{port}', childsname, password, recorder, random.Random(family_seed))
+            while time.monotonic() < deadline:
+                family.run_once()
+
+        threads = [threading.Thread(target=family_loop, args=(name, seed + i), daemon=True)
+                   for i, name in enumerate(families)]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    os.unlink(log_file.name)
+    return LoadResult(config, elapsed, recorder.summary(elapsed))
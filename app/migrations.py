@@ -0,0 +1,159 @@
+# Versioned schema migrations for SQLite (local) and Postgres (Heroku).
+#
+# upgrade() first runs db.create_all(), which creates any missing tables straight from the models
+# (including their indexes), then applies every migration not yet recorded in schema_version.
+# Each step must therefore be safe against a database that already has the change, which is why
+# indexes use IF NOT EXISTS and columns are checked before being added.
+
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import Boolean, Column, Float, ForeignKey, Integer, MetaData, String, Table, inspect, text
+
+from . import db
+
+MIGRATIONS = []
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+def _quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+def _create_index(conn, name, table, columns, unique=False):
+    cols = ', '.join(_quote(conn, c) for c in columns)
+    conn.execute(text(
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} ON {_quote(conn, table)} ({cols})"
+    ))
+
+def _add_column(conn, table, column, ddl):
+    if column not in {c['name'] for c in inspect(conn).get_columns(table)}:
+        conn.execute(text(f"ALTER TABLE {_quote(conn, table)} ADD COLUMN {_quote(conn, column)} {ddl}"))
+
+def _dedupe(conn, table, columns):
+    # Keep only the newest row per key so a unique index can be built over existing data. The rows
+    # removed are counted and logged first, as they cannot be got back.
+    quoted = _quote(conn, table)
+    cols = ', '.join(_quote(conn, c) for c in columns)
+    stale = f"FROM {quoted} WHERE id NOT IN (SELECT MAX(id) FROM {quoted} GROUP BY {cols})"
+    count = conn.execute(text(f"SELECT COUNT(*) {stale}")).scalar()
+    if count:
+        current_app.logger.warning('Removing %d duplicate %s rows (same %s), keeping the newest of each',
+                                   count, table, ', '.join(columns))
+        conn.execute(text(f"DELETE {stale}"))
+
+def _ensure_version_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version INTEGER PRIMARY KEY, "
+        "description VARCHAR(200) NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL)"
+    ))
+
+def applied_versions():
+    with db.engine.begin() as conn:
+        _ensure_version_table(conn)
+        return {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+def pending_versions():
+    done = applied_versions()
+    return sorted(version for version, _, _ in MIGRATIONS if version not in done)
+
+def check_schema():
+    # Refuse to run against a database that is missing migrations: upsert_rows needs the unique
+    # indexes added by migration 1, and without them every save fails
+    pending = pending_versions()
+    if pending:
+        raise RuntimeError(
+            f"Database schema is missing migrations {', '.join(map(str, pending))}; "
+            "run 'flask --app run db-upgrade' first"
+        )
+
+def upgrade():
+    db.create_all()
+    done = applied_versions()
+
+    applied = []
+    for version, description, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in done:
+            continue
+        # One transaction per migration, so a failure leaves earlier versions recorded
+        with db.engine.begin() as conn:
+            fn(conn)
+            conn.execute(
+                text("INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :t)"),
+                {'v': version, 'd': description, 't': datetime.now()}
+            )
+        applied.append((version, description))
+    return applied
+
+@migration(1, 'Composite indexes on per-user lookup columns and unique upsert keys')
+def _hot_lookup_indexes(conn):
+    _create_index(conn, 'ix_ingredient_user_name', 'ingredient', ['user_id', 'name'])
+    _create_index(conn, 'ix_recipe_user_name', 'recipe', ['user_id', 'name'])
+    _create_index(conn, 'ix_recipe_ingredient_recipe_id', 'recipe_ingredient', ['recipe_id'])
+    _create_index(conn, 'ix_recipe_ingredient_ingredient_id', 'recipe_ingredient', ['ingredient_id'])
+    _create_index(conn, 'ix_target_user_date', 'target', ['user_id', 'date', 'id'])
+    _create_index(conn, 'ix_target_breakdown_target_id', 'target_breakdown', ['target_id'])
+    _create_index(conn, 'ix_planner_entry_user_slot_date', 'planner_entry', ['user_id', 'slot', 'date'])
+
+    # The planner and log routes treat (user, date, slot) and (user, date, time) as the row key
+    _dedupe(conn, 'planner_entry', ['user_id', 'date', 'slot'])
+    _create_index(conn, 'uq_planner_entry_user_date_slot', 'planner_entry', ['user_id', 'date', 'slot'], unique=True)
+    _dedupe(conn, 'log_entry', ['user_id', 'date', 'slot'])
+    _create_index(conn, 'uq_log_entry_user_date_slot', 'log_entry', ['user_id', 'date', 'slot'], unique=True)
+    _dedupe(conn, 'ketone_log_entry', ['user_id', 'date', 'time'])
+    _create_index(conn, 'uq_ketone_log_entry_user_date_time', 'ketone_log_entry', ['user_id', 'date', 'time'],
+                  unique=True)
+
+@migration(2, 'Per-user data version for reference-data cache invalidation')
+def _users_data_version(conn):
+    _add_column(conn, 'users', 'data_version', 'INTEGER NOT NULL DEFAULT 0')
+
+def _rebuild_ingredient_table(conn):
+    # SQLite cannot drop a column's inline UNIQUE, so the table is recreated without it and the rows
+    # copied across. The columns are those of ingredient at version 3, written out here rather than
+    # taken from the model so later model changes don't alter this step. The old table is dropped
+    # before the new one takes its name, so the foreign keys of recipe_ingredient still point at
+    # "ingredient".
+    metadata = MetaData()
+    Table('users', metadata, Column('id', Integer, primary_key=True))
+    rebuilt = Table(
+        'ingredient_new', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('user_id', Integer, ForeignKey('users.id')),
+        Column('name', String(80), nullable=False),
+        Column('type', String(20), nullable=False),
+        Column('units', String(10), nullable=False),
+        Column('percent_fat', Float),
+        Column('percent_carbs', Float),
+        Column('percent_protein', Float),
+        Column('total_calories', Float),
+        Column('source', String(150)),
+        Column('unmeasured_ingredient', Boolean),
+    )
+    rebuilt.create(conn)
+    cols = ', '.join(_quote(conn, c.name) for c in rebuilt.columns)
+    conn.execute(text(f"INSERT INTO ingredient_new ({cols}) SELECT {cols} FROM ingredient"))
+    conn.execute(text("DROP TABLE ingredient"))
+    conn.execute(text("ALTER TABLE ingredient_new RENAME TO ingredient"))
+
+@migration(3, 'Ingredient names unique per user instead of across all users')
+def _ingredient_name_per_user(conn):
+    name_uniques = [u['name'] for u in inspect(conn).get_unique_constraints('ingredient')
+                    if u['column_names'] == ['name']]
+    conn.execute(text("DROP INDEX IF EXISTS ix_ingredient_user_name"))
+    if name_uniques and conn.dialect.name == 'sqlite':
+        _rebuild_ingredient_table(conn)
+    else:
+        for name in name_uniques:
+            conn.execute(text(f"ALTER TABLE ingredient DROP CONSTRAINT {_quote(conn, name)}"))
+    _create_index(conn, 'uq_ingredient_user_name', 'ingredient', ['user_id', 'name'], unique=True)
+
+@migration(4, 'Free-text log meals stored without a recipe id')
+def _custom_meals_without_recipe(conn):
+    # The log used to save free-text meals with recipe_id -1, which no recipe row has
+    conn.execute(text("UPDATE log_entry SET recipe_id = NULL WHERE recipe_id = -1"))
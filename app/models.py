@@ -6,9 +6,14 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from . import db
 
 class Ingredient(db.Model):
+    __table_args__ = (
+        # Each family names its own ingredients
+        db.Index('uq_ingredient_user_name', 'user_id', 'name', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    name = db.Column(db.String(80), unique=True, nullable=False)
+    name = db.Column(db.String(80), nullable=False)
     type = db.Column(db.String(20), nullable=False)  # e.g. fat, protein, carb
     units = db.Column(db.String(10), nullable=False)  # g or ml
     percent_fat = db.Column(db.Float)
@@ -19,6 +24,10 @@ class Ingredient(db.Model):
     unmeasured_ingredient = db.Column(db.Boolean, default=False)
 
 class Recipe(db.Model):
+    __table_args__ = (
+        db.Index('ix_recipe_user_name', 'user_id', 'name'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     name = db.Column(db.String(120), nullable=False)
@@ -34,6 +43,11 @@ class Recipe(db.Model):
     ingredients = db.relationship('RecipeIngredient', back_populates='recipe', cascade='all, delete-orphan')
 
 class RecipeIngredient(db.Model):
+    __table_args__ = (
+        db.Index('ix_recipe_ingredient_recipe_id', 'recipe_id'),
+        db.Index('ix_recipe_ingredient_ingredient_id', 'ingredient_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     recipe_id = db.Column(db.Integer, db.ForeignKey('recipe.id'), nullable=False)
     ingredient_id = db.Column(db.Integer, db.ForeignKey('ingredient.id'), nullable=False)
@@ -48,6 +62,10 @@ class RecipeIngredient(db.Model):
     ingredient = db.relationship('Ingredient')
 
 class Target(db.Model):
+    __table_args__ = (
+        db.Index('ix_target_user_date', 'user_id', 'date', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     ratio = db.Column(db.Numeric(4, 2), nullable=False)  # up to 2 decimal places
@@ -61,6 +79,10 @@ class Target(db.Model):
     breakdowns = db.relationship('TargetBreakdown', backref='target', lazy=True)
 
 class TargetBreakdown(db.Model):
+    __table_args__ = (
+        db.Index('ix_target_breakdown_target_id', 'target_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     item = db.Column(db.String(20), nullable=False)  # e.g. 'Meal' or 'Snack'
@@ -77,6 +99,7 @@ class Users(db.Model, UserMixin):
     childsname = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(512), nullable=False)
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # bumped when ingredients/recipes change
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -85,6 +108,11 @@ class Users(db.Model, UserMixin):
         return check_password_hash(self.password_hash, password)
 
 class PlannerEntry(db.Model):
+    __table_args__ = (
+        db.Index('uq_planner_entry_user_date_slot', 'user_id', 'date', 'slot', unique=True),
+        db.Index('ix_planner_entry_user_slot_date', 'user_id', 'slot', 'date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     date = db.Column(db.Date, nullable=False)
@@ -95,6 +123,10 @@ class PlannerEntry(db.Model):
     notes = db.Column(db.Text, nullable=True)  # notes for the planner entry
 
 class LogEntry(db.Model):
+    __table_args__ = (
+        db.Index('uq_log_entry_user_date_slot', 'user_id', 'date', 'slot', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     date = db.Column(db.Date, nullable=False)
@@ -106,6 +138,10 @@ class LogEntry(db.Model):
     recipe = db.relationship('Recipe')
 
 class KetoneLogEntry(db.Model):
+    __table_args__ = (
+        db.Index('uq_ketone_log_entry_user_date_time', 'user_id', 'date', 'time', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     date = db.Column(db.Date, nullable=False)
@@ -113,4 +149,25 @@ class KetoneLogEntry(db.Model):
     ketone_level = db.Column(db.Float, nullable=True)  # mmol/L
     glucose_level = db.Column(db.Float, nullable=True)  # optional, mmol/L
 
-    user = db.relationship('Users', backref='ketone_logs')
\ No newline at end of file
+    user = db.relationship('Users', backref='ketone_logs')
+
+class DailySummary(db.Model):
+    # What the log adds up to for one day, kept up to date by summaries.refresh_summaries
+    __table_args__ = (
+        db.Index('uq_daily_summary_user_date', 'user_id', 'date', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    fat = db.Column(db.Float, nullable=False, default=0)
+    carbs = db.Column(db.Float, nullable=False, default=0)
+    protein = db.Column(db.Float, nullable=False, default=0)
+    calories = db.Column(db.Float, nullable=False, default=0)
+    ratio = db.Column(db.Float, nullable=True)  # achieved fat : (carbs + protein)
+    meals_logged = db.Column(db.Integer, nullable=False, default=0)  # entries with a recipe
+    custom_meals = db.Column(db.Integer, nullable=False, default=0)  # free-text entries, macros unknown
+    target_id = db.Column(db.Integer, db.ForeignKey('target.id'), nullable=True)
+    target_calories = db.Column(db.Float, nullable=True)
+    target_ratio = db.Column(db.Float, nullable=True)
+    on_target = db.Column(db.Boolean, nullable=False, default=False)
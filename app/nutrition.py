@@ -0,0 +1,135 @@
+# Recipe nutrition maths.
+#
+# Ingredients are held as an ingredient x macro matrix (fat, carbs, protein, calories per gram or ml,
+# flattened into one array of doubles) and a recipe is a list of (ingredient, amount) pairs over its
+# rows. Totals for one recipe or a whole recipe book are a single multiply-accumulate pass, and the
+# bulk recompute reads everything it needs in one query.
+
+from array import array
+from collections import defaultdict
+
+from sqlalchemy import select, update
+
+from . import db
+from .models import Ingredient, Recipe, RecipeIngredient
+
+MACROS = ('fat', 'carbs', 'protein', 'calories')
+
+def ketogenic_ratio(fat, carbs, protein):
+    return fat / (protein + carbs) if (protein + carbs) > 0 else None
+
+class NutritionMatrix:
+    def __init__(self, rows):
+        # rows: (ingredient_id, percent_fat, percent_carbs, percent_protein, calories per 100g/ml)
+        self.index = {}
+        self.values = array('d')
+        for ingredient_id, *per_100 in rows:
+            if ingredient_id in self.index:
+                continue
+            self.index[ingredient_id] = len(self.index)
+            self.values.extend((v or 0.0) / 100 for v in per_100)
+
+    @classmethod
+    def for_ingredients(cls, ingredient_ids):
+        rows = (
+            db.session.query(
+                Ingredient.id, Ingredient.percent_fat, Ingredient.percent_carbs,
+                Ingredient.percent_protein, Ingredient.total_calories)
+            .filter(Ingredient.id.in_(set(ingredient_ids)))
+            .all()
+        )
+        return cls(rows)
+
+    def row_macros(self, ingredient_id, amount):
+        base = self.index[ingredient_id] * 4
+        v = self.values
+        return (v[base] * amount, v[base + 1] * amount, v[base + 2] * amount, v[base + 3] * amount)
+
+    def recipe_totals(self, items):
+        # items: iterable of (ingredient_id, amount)
+        fat = carbs = protein = calories = 0.0
+        v = self.values
+        for ingredient_id, amount in items:
+            base = self.index[ingredient_id] * 4
+            fat += v[base] * amount
+            carbs += v[base + 1] * amount
+            protein += v[base + 2] * amount
+            calories += v[base + 3] * amount
+        return fat, carbs, protein, calories
+
+    def bulk_totals(self, recipes):
+        # recipes: {recipe_id: [(ingredient_id, amount), ...]}
+        return {recipe_id: self.recipe_totals(items) for recipe_id, items in recipes.items()}
+
+def dependent_recipe_ids(ingredient_ids):
+    # Ingredient -> recipes dependency lookup, served by the recipe_ingredient.ingredient_id index
+    return (
+        select(RecipeIngredient.recipe_id)
+        .where(RecipeIngredient.ingredient_id.in_(set(ingredient_ids)))
+        .distinct()
+    )
+
+def recompute_recipes(user_id=None, recipe_ids=None, ingredient_ids=None):
+    # Recalculate per-row macros, totals and ratio for recipes built from ingredients.
+    # Hand-entered (calculated) recipes store NULL per-row macros and are left alone.
+    # Pass ingredient_ids to recompute only the recipes that use those ingredients.
+    # Returns [(recipe_id, old_ratio, new_ratio)] for every recipe recomputed; the caller commits.
+    query = (
+        db.session.query(
+            RecipeIngredient.id, RecipeIngredient.recipe_id, RecipeIngredient.ingredient_id,
+            RecipeIngredient.amount, RecipeIngredient.fat,
+            Ingredient.percent_fat, Ingredient.percent_carbs, Ingredient.percent_protein,
+            Ingredient.total_calories, Recipe.ratio)
+        .join(Ingredient, Ingredient.id == RecipeIngredient.ingredient_id)
+        .join(Recipe, Recipe.id == RecipeIngredient.recipe_id)
+    )
+    if user_id is not None:
+        query = query.filter(Recipe.user_id == user_id)
+    if recipe_ids is not None:
+        query = query.filter(RecipeIngredient.recipe_id.in_(set(recipe_ids)))
+    if ingredient_ids is not None:
+        query = query.filter(RecipeIngredient.recipe_id.in_(dependent_recipe_ids(ingredient_ids)))
+    rows = query.all()
+
+    matrix = NutritionMatrix((r.ingredient_id, r.percent_fat, r.percent_carbs, r.percent_protein, r.total_calories)
+                             for r in rows)
+
+    rows_by_recipe = defaultdict(list)
+    old_ratios = {}
+    hand_entered = set()
+    for r in rows:
+        rows_by_recipe[r.recipe_id].append(r)
+        old_ratios[r.recipe_id] = r.ratio
+        if r.fat is None:
+            hand_entered.add(r.recipe_id)
+
+    ingredient_based = {recipe_id: recipe_rows for recipe_id, recipe_rows in rows_by_recipe.items()
+                        if recipe_id not in hand_entered}
+    totals = matrix.bulk_totals({recipe_id: [(r.ingredient_id, r.amount) for r in recipe_rows]
+                                 for recipe_id, recipe_rows in ingredient_based.items()})
+
+    row_updates = []
+    recipe_updates = []
+    changes = []
+    for recipe_id, recipe_rows in ingredient_based.items():
+        for r in recipe_rows:
+            row_updates.append({'id': r.id, **dict(zip(MACROS, matrix.row_macros(r.ingredient_id, r.amount)))})
+
+        fat, carbs, protein, calories = totals[recipe_id]
+        ratio = ketogenic_ratio(fat, carbs, protein)
+        recipe_updates.append({
+            'id': recipe_id,
+            'total_fat': fat,
+            'total_carbs': carbs,
+            'total_protein': protein,
+            'total_calories': calories,
+            'ratio': ratio,
+        })
+        changes.append((recipe_id, old_ratios[recipe_id], ratio))
+
+    # Bulk UPDATE ... WHERE id = :id, executed as one executemany per table
+    if row_updates:
+        db.session.execute(update(RecipeIngredient), row_updates)
+    if recipe_updates:
+        db.session.execute(update(Recipe), recipe_updates)
+    return changes
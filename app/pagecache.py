@@ -0,0 +1,244 @@
+# Cache of rendered HTML: fragments of a user's pages, and whole pages that are the same for everyone.
+#
+# Each entry is stored under (user id, template) together with the version it was rendered at: the
+# release plus the user's data_version. The commits that change what the fragments show (adding or
+# editing ingredients and recipes, imports, target saves) bump data_version, so the next visit misses
+# and the newer rendering replaces the old one. Pages with a CSRF token are only cached in fragments
+# around the form, and whole pages are rendered afresh while flash messages are pending.
+#
+# PAGE_CACHE_BACKEND chooses where entries live: memory (each worker its own), file or sqlite (shared
+# by all the workers on a machine, under PAGE_CACHE_PATH), or none. Every backend evicts the least
+# recently used entries to stay under PAGE_CACHE_MAX_BYTES.
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, session
+from flask_login import current_user
+from markupsafe import Markup
+
+SHARED = 0  # user id of pages that are the same for everyone
+
+class MemoryBackend:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # (user id, name) -> (version, html, size)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id, name, version):
+        with self._lock:
+            entry = self._data.get((user_id, name))
+            if entry is None or entry[0] != version:
+                return None
+            self._data.move_to_end((user_id, name))
+            return entry[1]
+
+    def set(self, user_id, name, version, html):
+        size = len(html.encode())
+        with self._lock:
+            old = self._data.pop((user_id, name), None)
+            if old:
+                self._size -= old[2]
+            if size > self.max_bytes:
+                return
+            self._data[(user_id, name)] = (version, html, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, _, evicted) = self._data.popitem(last=False)
+                self._size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+class FileBackend:
+    # One file per (user, template), named after the key and holding the version on its first line, so a
+    # newer rendering overwrites the old one. Reads touch the file so the least recently used are the ones
+    # pruned. Pruning scans the directory, so each worker only does it every PRUNE_EVERY writes or once it
+    # has written a tenth of max_bytes since its last scan; between scans the total can run over a little.
+    PRUNE_EVERY = 100
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._writes = 0
+        self._written = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, user_id, name):
+        return os.path.join(self.directory, f'{user_id}-{hashlib.sha1(name.encode()).hexdigest()[:16]}.html')
+
+    def get(self, user_id, name, version):
+        path = self._path(user_id, name)
+        try:
+            with open(path, encoding='utf-8') as f:
+                if f.readline().rstrip('\n') != version:
+                    return None
+                html = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return html
+
+    def set(self, user_id, name, version, html):
+        content = f'{version}\n{html}'
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp, self._path(user_id, name))
+
+        with self._lock:
+            self._writes += 1
+            self._written += len(content.encode())
+            if self._writes < self.PRUNE_EVERY and self._written * 10 < self.max_bytes:
+                return
+            self._writes = self._written = 0
+        self._prune()
+
+    def _prune(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith('.html'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, old_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(old_path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(('.html', '.tmp')):
+                self._remove(entry.path)
+
+class SQLiteBackend:
+    # One row per (user, template) in a WAL-mode SQLite file, with a connection per thread
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS page_cache ('
+            ' user_id INTEGER NOT NULL, name TEXT NOT NULL, version TEXT NOT NULL, html TEXT NOT NULL,'
+            ' size INTEGER NOT NULL, used REAL NOT NULL, PRIMARY KEY (user_id, name))'
+        )
+
+    def _connection(self):
+        # A connection opened before gunicorn forked belongs to the parent process
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, user_id, name, version):
+        conn = self._connection()
+        row = conn.execute(
+            'SELECT html FROM page_cache WHERE user_id = ? AND name = ? AND version = ?',
+            (user_id, name, version)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute('UPDATE page_cache SET used = ? WHERE user_id = ? AND name = ?', (time.time(), user_id, name))
+        return row[0]
+
+    def set(self, user_id, name, version, html):
+        size = len(html.encode())
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO page_cache (user_id, name, version, html, size, used) VALUES (?, ?, ?, ?, ?, ?)',
+                (user_id, name, version, html, size, time.time())
+            )
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM page_cache').fetchone()[0]
+            if total > self.max_bytes:
+                rows = conn.execute('SELECT user_id, name, size FROM page_cache ORDER BY used').fetchall()
+                for old_user_id, old_name, old_size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute('DELETE FROM page_cache WHERE user_id = ? AND name = ?', (old_user_id, old_name))
+                    total -= old_size
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def clear(self):
+        self._connection().execute('DELETE FROM page_cache')
+
+def make_backend(kind, path, max_bytes):
+    if kind == 'memory':
+        return MemoryBackend(max_bytes)
+    if kind == 'file':
+        return FileBackend(path, max_bytes)
+    if kind == 'sqlite':
+        return SQLiteBackend(os.path.join(path, 'pages.sqlite3'), max_bytes)
+    if kind == 'none':
+        return None
+    raise ValueError(f'Unknown PAGE_CACHE_BACKEND {kind!r}; expected memory, file, sqlite or none')
+
+class PageCache:
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def _get_or_render(self, user_id, name, version, render):
+        if self.backend is None:
+            return render()
+        version = f'{current_app.extensions["release_token"]}:{version}'
+        try:
+            html = self.backend.get(user_id, name, version)
+        except (OSError, sqlite3.Error):
+            current_app.logger.warning('page cache read failed for %s', name, exc_info=True)
+            return render()
+        if html is None:
+            html = render()
+            try:
+                self.backend.set(user_id, name, version, html)
+            except (OSError, sqlite3.Error):
+                current_app.logger.warning('page cache write failed for %s', name, exc_info=True)
+        return html
+
+    def fragment(self, name, render):
+        # A part of the current user's page built only from their own data; render() returns its HTML
+        return Markup(self._get_or_render(current_user.id, name, current_user.data_version, render))
+
+    def page(self, name, render):
+        # A whole page that is the same for every user until the next release
+        if session.get('_flashes'):
+            return render()
+        return self._get_or_render(SHARED, name, 0, render)
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+page_cache = PageCache()
+
+def init_app(app):
+    # After conditional.init_app, which works out the release token
+    page_cache.backend = make_backend(
+        app.config['PAGE_CACHE_BACKEND'], app.config['PAGE_CACHE_PATH'], app.config['PAGE_CACHE_MAX_BYTES'])
@@ -0,0 +1,122 @@
+# Opt-in cProfile capture of whole requests: the view, its queries and render_template.
+#
+# An admin profiles a single request by adding ?profile=1 to it, and PROFILE_SAMPLE_RATE profiles
+# that fraction of all requests. Each capture is written to PROFILE_DIR as <id>.prof (load it with
+# pstats or snakeviz) next to <id>.json holding the route, user and the instrumentation timings,
+# and only the newest PROFILE_KEEP captures are kept.
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import time
+from datetime import datetime
+
+from flask import g, request
+from flask_login import current_user
+
+from .auth import is_admin
+
+PROFILE_ID = re.compile(r'^[0-9]{8}-[0-9]{6}-[0-9]{6}-[A-Za-z0-9_.-]+$')
+
+def _capture_reason(app):
+    # 'requested', 'sampled' or None; the profile pages themselves are never profiled
+    if request.endpoint in (None, 'static') or request.endpoint.startswith('main.profile'):
+        return None
+    if request.args.get('profile') and is_admin(current_user):
+        return 'requested'
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    if rate > 0 and random.random() < rate:
+        return 'sampled'
+    return None
+
+def _prune(directory, keep):
+    ids = sorted(_profile_ids(directory), reverse=True)
+    for profile_id in ids[keep:]:
+        for ext in ('.prof', '.json'):
+            try:
+                os.remove(os.path.join(directory, profile_id + ext))
+            except FileNotFoundError:
+                pass
+
+def _profile_ids(directory):
+    if not os.path.isdir(directory):
+        return []
+    return [name[:-5] for name in os.listdir(directory) if name.endswith('.json') and PROFILE_ID.match(name[:-5])]
+
+def list_profiles(directory):
+    # Newest first; each entry is the capture's metadata plus its id
+    profiles = []
+    for profile_id in sorted(_profile_ids(directory), reverse=True):
+        try:
+            with open(os.path.join(directory, profile_id + '.json')) as f:
+                profiles.append({'id': profile_id, **json.load(f)})
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+def profile_report(directory, profile_id, sort='cumulative', limit=60):
+    # Text report of one capture, or None if there is no such capture
+    if not PROFILE_ID.match(profile_id):
+        return None
+    path = os.path.join(directory, profile_id + '.prof')
+    if not os.path.exists(path):
+        return None
+    out = io.StringIO()
+    stats = pstats.Stats(path, stream=out)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return out.getvalue()
+
+def init_app(app):
+    # Registered after the instrumentation hooks, so their query and render counters are already on g
+    directory = app.config['PROFILE_DIR']
+
+    @app.before_request
+    def start_profile():
+        reason = _capture_reason(app)
+        if reason is None:
+            return
+        g.profile_reason = reason
+        g.profile_started = time.perf_counter()
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+    @app.after_request
+    def save_profile(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        wall_ms = (time.perf_counter() - g.profile_started) * 1000
+
+        now = datetime.now()
+        profile_id = f'{now:%Y%m%d-%H%M%S-%f}-{request.endpoint}'
+        meta = {
+            'captured_at': now.isoformat(timespec='seconds'),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'user_id': current_user.get_id(),
+            'reason': g.profile_reason,
+            'wall_ms': round(wall_ms, 1),
+            'queries': g.get('sql_queries'),
+            'sql_ms': round(g.get('sql_seconds', 0.0) * 1000, 1),
+            'render_ms': round(g.get('render_seconds', 0.0) * 1000, 1),
+        }
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+            profiler.dump_stats(os.path.join(directory, profile_id + '.prof'))
+            with open(os.path.join(directory, profile_id + '.json'), 'w') as f:
+                json.dump(meta, f)
+            _prune(directory, app.config['PROFILE_KEEP'])
+        except OSError:
+            app.logger.exception('Could not save profile %s', profile_id)
+            return response
+
+        app.logger.info('profile saved id=%s wall_ms=%.1f', profile_id, wall_ms)
+        return response
@@ -0,0 +1,110 @@
+from bisect import bisect_right
+from collections import defaultdict
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import selectinload
+
+from . import db
+from .models import Recipe, RecipeIngredient, PlannerEntry
+
+def owned(model, user_id):
+    # Query over one family's rows of a per-user model. Every request reads its data through this, so
+    # its cost depends on that family's rows alone and the (user_id, ...) indexes are the ones used.
+    return model.query.filter(model.user_id == user_id)
+
+def load_recipe_catalog(user_id, recipe_ids=None):
+    # One query for the recipes, one for their RecipeIngredient rows and one for the Ingredients,
+    # so templates can walk recipe.ingredients / ri.ingredient without lazy loads.
+    # Pass recipe_ids to load only those recipes.
+    query = owned(Recipe, user_id)
+    if recipe_ids is not None:
+        recipe_ids = [r_id for r_id in recipe_ids if r_id and r_id > 0]
+        if not recipe_ids:
+            return []
+        query = query.filter(Recipe.id.in_(recipe_ids))
+
+    return (
+        query
+        .options(selectinload(Recipe.ingredients).selectinload(RecipeIngredient.ingredient))
+        .order_by(Recipe.name)
+        .all()
+    )
+
+def effective_planner_entries(user_id, slots):
+    # The planner entry that applies to each (date, slot) pair: the newest entry for that slot dated on
+    # or before the day. Entries inside the window and the last entry per slot before it come back in
+    # one query, then each pair is resolved in memory.
+    if not slots:
+        return {}
+
+    start = min(d for d, _ in slots)
+    end = max(d for d, _ in slots)
+    labels = {label for _, label in slots}
+
+    latest_before = (
+        db.session.query(PlannerEntry.slot.label('slot'), func.max(PlannerEntry.date).label('date'))
+        .filter(
+            PlannerEntry.user_id == user_id,
+            PlannerEntry.slot.in_(labels),
+            PlannerEntry.date < start
+        )
+        .group_by(PlannerEntry.slot)
+        .subquery()
+    )
+    rows = (
+        owned(PlannerEntry, user_id)
+        .outerjoin(latest_before, and_(
+            latest_before.c.slot == PlannerEntry.slot,
+            latest_before.c.date == PlannerEntry.date
+        ))
+        .filter(
+            PlannerEntry.slot.in_(labels),
+            or_(PlannerEntry.date.between(start, end), latest_before.c.date.isnot(None))
+        )
+        .order_by(PlannerEntry.date)
+        .all()
+    )
+
+    entries_by_slot = defaultdict(list)
+    for e in rows:
+        entries_by_slot[e.slot].append(e)
+    dates_by_slot = {label: [e.date for e in entries] for label, entries in entries_by_slot.items()}
+
+    resolved = {}
+    for d, label in slots:
+        pos = bisect_right(dates_by_slot.get(label, []), d)
+        if pos:
+            resolved[(d, label)] = entries_by_slot[label][pos - 1]
+    return resolved
+
+def upsert_rows(model, rows, key_columns):
+    # Insert or update many rows keyed on a unique index, using native INSERT ... ON CONFLICT on
+    # Postgres and SQLite. Columns present in the rows other than the key are overwritten.
+    if not rows:
+        return
+
+    # A single ON CONFLICT statement may not touch the same row twice, so the last row per key wins
+    rows = list({tuple(row[c] for c in key_columns): row for row in rows}.values())
+    update_columns = [c for c in rows[0] if c not in key_columns]
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(model)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(model)
+    else:
+        for row in rows:
+            existing = model.query.filter_by(**{c: row[c] for c in key_columns}).first()
+            if existing:
+                for c in update_columns:
+                    setattr(existing, c, row[c])
+            else:
+                db.session.add(model(**row))
+        return
+
+    stmt = stmt.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={c: stmt.excluded[c] for c in update_columns}
+    )
+    db.session.execute(stmt, rows)
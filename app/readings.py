@@ -0,0 +1,171 @@
+# Bulk import of ketone/glucose meter exports into KetoneLogEntry.
+#
+# Files are read with the ingredient importer's streaming CSV/JSON reader. A reading is either one
+# row with ketone and/or glucose columns, or a row per measurement with type and value columns (as
+# most meter apps export); readings taken in the same minute are merged into one log row, as on the
+# log page. Rows are compared with what is already stored a chunk at a time, then written with one
+# upsert per chunk. The whole file is one transaction.
+
+import csv
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from . import db
+from .importer import read_records
+from .models import KetoneLogEntry
+from .queries import owned, upsert_rows
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+MG_DL_PER_MMOL_L = 18.0  # glucose
+
+TIMESTAMP_COLUMNS = ('timestamp', 'datetime', 'date time', 'date/time', 'time stamp', 'recorded at')
+DATE_COLUMNS = ('date',)
+TIME_COLUMNS = ('time',)
+KETONE_COLUMNS = ('ketone_level', 'ketones', 'ketone', 'bhb', 'ketones (mmol/l)', 'blood ketones')
+GLUCOSE_COLUMNS = ('glucose_level', 'glucose', 'blood glucose', 'bg', 'glucose (mmol/l)', 'glucose (mg/dl)')
+TIMESTAMP_FORMATS = ('%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M', '%d/%m/%Y %H:%M:%S',
+                     '%d-%m-%Y %H:%M', '%Y/%m/%d %H:%M')
+
+@dataclass
+class ReadingsReport:
+    rows: int = 0
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0  # already stored with the same values, or merged with another row of the file
+    invalid: int = 0
+    errors: list = field(default_factory=list)  # (row number, message)
+
+    def add_error(self, row_number, message):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((row_number, message))
+
+def _first(record, columns):
+    return next((record[c] for c in columns if record.get(c) not in (None, '')), None)
+
+def _parse_timestamp(record):
+    value = _first(record, TIMESTAMP_COLUMNS)
+    if value is None:
+        d, t = _first(record, DATE_COLUMNS), _first(record, TIME_COLUMNS)
+        if d is None or t is None:
+            raise ValueError('no timestamp, or date and time')
+        value = f'{d} {t}'
+    value = str(value).strip()
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        for fmt in TIMESTAMP_FORMATS:
+            try:
+                parsed = datetime.strptime(value, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(f'unrecognised timestamp {value!r}')
+    # The log stores wall-clock time to the minute, as the meter showed it. A UTC offset on the timestamp
+    # is dropped rather than converted: the server's timezone is not the family's, and the offset is
+    # already the one the meter was set to.
+    return parsed.date(), parsed.time().replace(second=0, microsecond=0, tzinfo=None)
+
+def _level(value):
+    level = float(value)
+    if level < 0:
+        raise ValueError(f'negative reading {value!r}')
+    return level
+
+def _mmol_per_l(mg_dl):
+    # Converted glucose is kept to the 0.1 mmol/L meters show; values read in mmol/L are stored as given
+    return round(mg_dl / MG_DL_PER_MMOL_L, 1)
+
+def _parse_levels(record):
+    # (ketone_level, glucose_level), either of which may be None
+    if record.get('type') not in (None, '') and record.get('value') not in (None, ''):
+        kind = str(record['type']).lower()
+        unit = str(record.get('unit') or record.get('units') or '').lower()
+        value = _level(record['value'])
+        if 'keton' in kind or 'bhb' in kind:
+            return value, None
+        if 'gluc' in kind or kind == 'bg':
+            return None, _mmol_per_l(value) if 'mg' in unit else value
+        raise ValueError(f'unknown reading type {record["type"]!r}')
+
+    ketones = _first(record, KETONE_COLUMNS)
+    glucose_column = next((c for c in GLUCOSE_COLUMNS if record.get(c) not in (None, '')), None)
+    glucose = _level(record[glucose_column]) if glucose_column else None
+    if glucose is not None and 'mg' in (glucose_column + str(record.get('glucose unit') or '')).lower():
+        glucose = _mmol_per_l(glucose)
+    return (_level(ketones) if ketones is not None else None), glucose
+
+def _parse(record):
+    record = {str(k).strip().lower(): v for k, v in record.items() if k is not None}
+    d, t = _parse_timestamp(record)
+    ketones, glucose = _parse_levels(record)
+    if ketones is None and glucose is None:
+        raise ValueError('no ketone or glucose value')
+    return d, t, ketones, glucose
+
+def _flush(user_id, chunk, report):
+    # chunk: {(date, time): {'ketone_level': ..., 'glucose_level': ...}} with only the values read
+    dates = {d for d, _ in chunk}
+    existing = {
+        (k.date, k.time): k
+        for k in owned(KetoneLogEntry, user_id).filter(KetoneLogEntry.date.in_(dates))
+    }
+
+    rows = []
+    for (d, t), levels in chunk.items():
+        stored = existing.get((d, t))
+        row = {
+            'user_id': user_id, 'date': d, 'time': t,
+            'ketone_level': stored.ketone_level if stored else None,
+            'glucose_level': stored.glucose_level if stored else None,
+        }
+        row.update(levels)
+        if stored is None:
+            report.inserted += 1
+        elif (row['ketone_level'], row['glucose_level']) == (stored.ketone_level, stored.glucose_level):
+            report.skipped += 1
+            continue
+        else:
+            report.updated += 1
+        rows.append(row)
+
+    upsert_rows(KetoneLogEntry, rows, ['user_id', 'date', 'time'])
+    # The upsert bypasses the session, so later chunks must not see stale rows
+    db.session.expire_all()
+
+def import_readings(user_id, stream, fmt):
+    # Returns a ReadingsReport and commits; raises ValueError (and saves nothing) for an unreadable file
+    report = ReadingsReport()
+    chunk = {}
+    try:
+        for row_number, record in enumerate(read_records(stream, fmt), start=1):
+            report.rows += 1
+            try:
+                d, t, ketones, glucose = _parse(record)
+            except (ValueError, TypeError) as e:
+                report.add_error(row_number, str(e))
+                continue
+
+            levels = chunk.get((d, t))
+            if levels is None:
+                levels = chunk[(d, t)] = {}
+            else:
+                report.skipped += 1  # merged into an earlier reading from the same minute
+            if ketones is not None:
+                levels['ketone_level'] = ketones
+            if glucose is not None:
+                levels['glucose_level'] = glucose
+
+            if len(chunk) >= CHUNK_SIZE:
+                _flush(user_id, chunk, report)
+                chunk = {}
+        if chunk:
+            _flush(user_id, chunk, report)
+    except (UnicodeDecodeError, csv.Error, ValueError) as e:
+        db.session.rollback()
+        raise ValueError(f'Could not read the file: {e}') from e
+
+    db.session.commit()
+    return report
@@ -1,15 +1,35 @@
-from datetime import date, timedelta, datetime
+import re
+from datetime import date, timedelta
 from collections import defaultdict
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import (
+    Blueprint, render_template, request, redirect, url_for, flash, abort, jsonify, make_response, current_app,
+    send_from_directory, Response, stream_with_context)
 from flask_login import login_user, logout_user, login_required, current_user
+from sqlalchemy import func, select
+from werkzeug.datastructures import MultiDict
 from . import db
 from .models import (
     Ingredient, Recipe, RecipeIngredient, Target, TargetBreakdown, Users, PlannerEntry, LogEntry, KetoneLogEntry)
 from .forms import (
     RecipeForm, CalculatedRecipeForm, TargetForm, LoginForm, RegistrationForm, IngredientForm, PlannerForm, 
-    PlannerSlotForm, LogForm, LogSlotForm)
+    PlannerSlotForm, LogForm, LogSlotForm, IngredientImportForm, ReadingsImportForm)
 from .seed_db import seed_ingredients
+from .queries import owned, load_recipe_catalog, effective_planner_entries, upsert_rows
+from .shopping import build_shopping_list
+from .exports import EXPORTS, FORMATS, export_chunks
+from .importer import import_ingredients, format_for
+from .readings import import_readings
+from .summaries import refresh_summaries, month_summaries, year_summaries
+from .timeline import group_slots
+from .nutrition import NutritionMatrix, ketogenic_ratio, recompute_recipes, dependent_recipe_ids
+from .auth import admin_required
+from .conditional import conditional_page, static_page
+from .pagecache import page_cache
+from .instrumentation import request_metrics
+from .profiling import list_profiles, profile_report
+from .cache import (
+    bump_data_version, ingredient_index, recipe_choices as cached_recipe_choices, recipe_labels, target_timeline)
 
 main = Blueprint('main', __name__)
 
@@ -23,15 +43,22 @@ def index():
 
 @main.route('/ingredients', methods=['GET'])
 @login_required
+@conditional_page(form=True)
 def ingredients():
-    all_ingredients = Ingredient.query.filter_by(unmeasured_ingredient=False).all()
     form = IngredientForm()
-    return render_template('ingredients.html', ingredients=all_ingredients, form=form)
+    return render_template('ingredients.html', ingredients_table=_ingredients_table(), form=form)
+
+def _ingredients_table():
+    def render():
+        all_ingredients = owned(Ingredient, current_user.id).filter_by(unmeasured_ingredient=False).all()
+        return render_template('_ingredients_table.html', ingredients=all_ingredients)
+    return page_cache.fragment('_ingredients_table.html', render)
 
 @main.route('/ingredients', methods=['POST'])
 @login_required
 def add_ingredient():
     form = IngredientForm()
+    form.set_owner(current_user.id)
     if form.validate_on_submit():
         new_ingredient = Ingredient(
             name=form.name.data,
@@ -46,34 +73,85 @@ def add_ingredient():
             unmeasured_ingredient=False,
         )
         db.session.add(new_ingredient)
+        bump_data_version(current_user.id)
         db.session.commit()
         flash(f'Added ingredient: {new_ingredient.name}', 'success')
         return redirect(url_for('main.ingredients'))
     else:
         # On validation failure, re-render the ingredients page with errors and form data
-        all_ingredients = Ingredient.query.all()
-        return render_template('ingredients.html', ingredients=all_ingredients, form=form)
+        return render_template('ingredients.html', ingredients_table=_ingredients_table(), form=form)
+
+@main.route('/ingredients/import', methods=['GET', 'POST'])
+@login_required
+def import_ingredients_upload():
+    form = IngredientImportForm()
+    report = None
+    if form.validate_on_submit():
+        upload = form.file.data
+        defaults = {'type': form.default_type.data, 'units': form.default_units.data,
+                    'source': form.default_source.data}
+        try:
+            report = import_ingredients(current_user.id, upload.stream, format_for(upload.filename),
+                                        defaults=defaults, dry_run=form.dry_run.data)
+        except ValueError as e:
+            flash(str(e), 'danger')
+        else:
+            if not report.dry_run and report.inserted:
+                flash(f'Imported {report.inserted} ingredients.', 'success')
+
+    return render_template('import_ingredients.html', form=form, report=report)
+
+@main.route('/ingredients/search')
+@login_required
+def search_ingredients():
+    # Ranked matches for the recipe pages' ingredient search; measured=1 leaves out fruit/veg groups
+    results = ingredient_index(current_user).search(
+        request.args.get('q', ''),
+        limit=request.args.get('limit', 20, type=int),
+        measured_only=bool(request.args.get('measured', type=int)),
+    )
+    return jsonify(results)
+
+@main.route('/ingredients/<int:ingredient_id>/edit', methods=['GET', 'POST'])
+@login_required
+def edit_ingredient(ingredient_id):
+    ingredient = owned(Ingredient, current_user.id).filter_by(id=ingredient_id).first_or_404()
+    form = IngredientForm(obj=ingredient)
+    form.set_owner(current_user.id, ingredient.id)
+    if ingredient.unmeasured_ingredient:
+        form.allow_blank_macros()
+
+    if form.validate_on_submit():
+        macros = (form.percent_fat.data, form.percent_carbs.data, form.percent_protein.data)
+        ingredient.name = form.name.data
+        ingredient.type = form.type.data
+        ingredient.units = form.units.data
+        ingredient.percent_fat, ingredient.percent_carbs, ingredient.percent_protein = macros
+        # The page's script fills in 0 calories when the percentages are left blank
+        ingredient.total_calories = form.total_calories.data if any(m is not None for m in macros) else None
+        ingredient.source = form.source.data
+        db.session.flush()
+
+        # Refresh the stored macros of every recipe that uses this ingredient
+        changes = recompute_recipes(user_id=current_user.id, ingredient_ids=[ingredient.id])
+        refresh_summaries(current_user.id, recipe_ids=[recipe_id for recipe_id, _, _ in changes])
+
+        bump_data_version(current_user.id)
+        db.session.commit()
+        flash(f'Updated ingredient: {ingredient.name} ({len(changes)} recipes recalculated)', 'success')
+        return redirect(url_for('main.ingredients'))
+
+    recipe_count = db.session.scalar(
+        select(func.count()).select_from(dependent_recipe_ids([ingredient.id]).subquery())
+    )
+    return render_template('edit_ingredient.html', form=form, ingredient=ingredient, recipe_count=recipe_count)
 
 @main.route('/recipes/new', methods=['GET', 'POST'])
 @login_required
 def new_recipe():
     form = RecipeForm()
-    nutrition_data = {}
-    form.set_ingredient_choices()
-
-    # Gather nutritional info to pass to JS
-    all_ingredients = Ingredient.query.order_by(Ingredient.name).all()
-    nutrition_data = {
-        ing.id: {
-            'name': ing.name,
-            'units': ing.units,
-            'percent_fat': ing.percent_fat,
-            'percent_carbs': ing.percent_carbs,
-            'percent_protein': ing.percent_protein,
-            'total_calories': ing.total_calories
-        }
-        for ing in all_ingredients
-    }
+    index = ingredient_index(current_user)
+    form.set_ingredient_choices(index.measured_labels)
 
     if form.validate_on_submit():
         # Create recipe object
@@ -85,25 +163,14 @@ def new_recipe():
             user_id=current_user.id,
         )
 
-        total_fat = total_carbs = total_protein = total_calories = 0.0
-
-        for ingredient_form in form.ingredients.entries:
-            ingredient = Ingredient.query.get(ingredient_form.ingredient_id.data)
-            amount = ingredient_form.amount.data
+        items = [(f.ingredient_id.data, f.amount.data) for f in form.ingredients.entries]
+        matrix = NutritionMatrix.for_ingredients(ingredient_id for ingredient_id, _ in items)
 
+        for ingredient_id, amount in items:
             # Calculate nutrition for this ingredient amount
-            fat = ingredient.percent_fat * amount / 100
-            carbs = ingredient.percent_carbs * amount / 100
-            protein = ingredient.percent_protein * amount / 100
-            calories = ingredient.total_calories * amount / 100
-
-            total_fat += fat
-            total_carbs += carbs
-            total_protein += protein
-            total_calories += calories
-
+            fat, carbs, protein, calories = matrix.row_macros(ingredient_id, amount)
             ri = RecipeIngredient(
-                ingredient_id=ingredient.id,
+                ingredient_id=ingredient_id,
                 amount=amount,
                 fat=fat,
                 carbs=carbs,
@@ -113,27 +180,35 @@ def new_recipe():
             recipe.ingredients.append(ri)
 
         # Save totals in recipe
+        total_fat, total_carbs, total_protein, total_calories = matrix.recipe_totals(items)
         recipe.total_fat = total_fat
         recipe.total_carbs = total_carbs
         recipe.total_protein = total_protein
         recipe.total_calories = total_calories
-        recipe.ratio = total_fat / (total_protein + total_carbs) if (total_protein + total_carbs) > 0 else None
+        recipe.ratio = ketogenic_ratio(total_fat, total_carbs, total_protein)
 
         db.session.add(recipe)
+        bump_data_version(current_user.id)
         db.session.commit()
 
         flash('Recipe created successfully!', 'success')
         return redirect(url_for('main.recipes'))
     
-    latest_target = Target.query.order_by(Target.date.desc(), Target.id.desc()).first()
+    target = target_timeline(current_user).at(date.today())
 
-    return render_template('new_recipe.html', form=form, nutrition_data=nutrition_data, target=latest_target)
+    # Nutrition of the ingredients already chosen when the form is shown again; the page's JS gets the
+    # rest from the search results
+    nutrition_data = {
+        f.ingredient_id.data: index.entries[f.ingredient_id.data]
+        for f in form.ingredients.entries if f.ingredient_id.data in index.measured_labels
+    }
+    return render_template('new_recipe.html', form=form, nutrition_data=nutrition_data, target=target)
 
 @main.route('/recipes/new_calculated', methods=['GET', 'POST'])
 @login_required
 def new_calculated_recipe():
     form = CalculatedRecipeForm()
-    form.set_ingredient_choices()
+    form.set_ingredient_choices(ingredient_index(current_user).labels)
 
     if form.validate_on_submit():
         recipe = Recipe(
@@ -146,10 +221,8 @@ def new_calculated_recipe():
             total_carbs=form.total_carbs.data,
             total_protein=form.total_protein.data,
             total_calories=form.total_calories.data,
-            ratio=form.ratio.data if form.ratio.data else (
-                form.total_fat.data / (form.total_carbs.data + form.total_protein.data)
-                if (form.total_carbs.data + form.total_protein.data) > 0 else None
-            )
+            ratio=form.ratio.data if form.ratio.data else ketogenic_ratio(
+                form.total_fat.data, form.total_carbs.data, form.total_protein.data)
         )
 
         for ingredient_form in form.ingredients.entries:
@@ -167,6 +240,7 @@ def new_calculated_recipe():
                 recipe.ingredients.append(ri)
 
         db.session.add(recipe)
+        bump_data_version(current_user.id)
         db.session.commit()
         flash('Calculated Recipe created successfully!', 'success')
         return redirect(url_for('main.recipes'))
@@ -175,22 +249,27 @@ def new_calculated_recipe():
 
 @main.route('/recipes')
 @login_required
+@conditional_page()
 def recipes():
-    all_recipes = Recipe.query.order_by(Recipe.name).all()
-    
-    grouped = {
-        'breakfast': [],
-        'main': [],
-        'snack': []
-    }
-    for recipe in all_recipes:
-        if recipe.meal_type in grouped:
-            grouped[recipe.meal_type].append(recipe)
+    def render_tables():
+        all_recipes = load_recipe_catalog(current_user.id)
 
-    return render_template('recipes.html', recipes_by_type=grouped)
+        grouped = {
+            'breakfast': [],
+            'main': [],
+            'snack': []
+        }
+        for recipe in all_recipes:
+            if recipe.meal_type in grouped:
+                grouped[recipe.meal_type].append(recipe)
+
+        return render_template('_recipe_tables.html', recipes_by_type=grouped)
+
+    return render_template('recipes.html', recipe_tables=page_cache.fragment('_recipe_tables.html', render_tables))
 
 @main.route('/targets', methods=['GET', 'POST'])
 @login_required
+@conditional_page(form=True)
 def targets():
     form = TargetForm()
     if form.validate_on_submit():
@@ -236,12 +315,17 @@ def targets():
             )
             db.session.add(snack_breakdown)
 
+        # Days from today on are now measured against the new target
+        refresh_summaries(current_user.id, since=new_target.date)
+        bump_data_version(current_user.id)
         db.session.commit()
         return redirect(url_for('main.targets'))
 
-    latest_target = Target.query.order_by(Target.date.desc(), Target.id.desc()).first()
+    def render_target():
+        return render_template('_target_display.html', target=target_timeline(current_user).latest)
 
-    return render_template('targets.html', target=latest_target, form=form)
+    return render_template('targets.html', target_display=page_cache.fragment('_target_display.html', render_target),
+                           form=form)
 
 @main.route('/login', methods=['GET', 'POST'])
 def login():
@@ -293,57 +377,73 @@ def signup():
 
     return render_template('signup.html', form=form)
 
-@main.route('/planner', methods=['GET', 'POST'])
-@login_required
-def planner():
-    today = date.today()
-    days = [today + timedelta(days=i) for i in range(10)]
-
-    # Latest targets
-    tgt = Target.query.filter_by(user_id=current_user.id).order_by(Target.date.desc()).first()
-    if not tgt:
-        flash("Please set your daily targets first.", "warning")
-        return redirect(url_for('main.targets'))
-
-    # Compute slots
-    slots = []
-    for d in days:
-        for m in range(1, tgt.num_main_meals + 1):
-            label = {1:'Breakfast', 2:'Lunch', 3:'Dinner'}.get(m, f'Meal {m}')
-            slots.append((d, label))
-        for s in range(1, tgt.num_snacks + 1):
-            slots.append((d, f'Snack {s}'))
+PAGE_DAYS = 10  # days rendered with the planner/log page itself
+LAZY_PAGE_DAYS = 7  # days per lazily loaded fragment beyond the first screen
+MAX_WINDOW_DAYS = 93
+
+def _date_window():
+    # ?start=YYYY-MM-DD&days=N, defaulting to the 10 days from today
+    try:
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else date.today()
+    except ValueError:
+        start = date.today()
+    num_days = min(max(request.args.get('days', PAGE_DAYS, type=int), 1), MAX_WINDOW_DAYS)
+    return start, num_days
+
+def _window_nav(start, num_days):
+    # Template context for the window heading, week paging links and the lazy loader
+    end = start + timedelta(days=num_days - 1)
+    first_screen_end = start + timedelta(days=min(num_days, PAGE_DAYS) - 1)
+    return {
+        'start': start,
+        'end': end,
+        'num_days': num_days,
+        'prev_start': start - timedelta(days=7),
+        'next_start': start + timedelta(days=7),
+        'lazy_start': first_screen_end + timedelta(days=1) if first_screen_end < end else None,
+    }
 
-    grouped_slots = defaultdict(list)
-    for d, label in slots:
-        grouped_slots[d].append(label)
-    slots_by_day = sorted(grouped_slots.items())
+def _fragment_window():
+    # Keyset cursor for a lazily loaded fragment: the first day to render and the last day of the window
+    try:
+        start = date.fromisoformat(request.args['start'])
+        until = date.fromisoformat(request.args['until'])
+    except (KeyError, ValueError):
+        abort(400)
+    end = min(start + timedelta(days=LAZY_PAGE_DAYS - 1), until)
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    next_start = end + timedelta(days=1) if end < until else None
+    return days, next_start
+
+def _posted_days(days):
+    # Only the days rendered on the page (including lazily loaded ones) are submitted with the form
+    posted = set()
+    for value in request.form.getlist('loaded_day'):
+        try:
+            posted.add(date.fromisoformat(value))
+        except ValueError:
+            continue
+    return sorted(posted.intersection(days)) or days[:PAGE_DAYS]
 
-    # Map for slot index lookup in template (to get idx by (date, slot_label))
-    slot_index_map = {key: idx for idx, key in enumerate(slots)}
+def _planner_form(days, timeline, formdata=None):
+    slots = timeline.slots(days)
+    slots_by_day, slot_index_map = group_slots(slots)
 
-    # Fetch recipes for dropdown
-    recipes = Recipe.query.filter_by(user_id=current_user.id).all()
-    recipe_choices = [(0, '-- Select --')] + [(r.id, r.name) for r in recipes] + [(-1, 'CUSTOM')]
+    # Recipes for dropdown
+    recipe_choices = cached_recipe_choices(current_user)
 
     # Existing entries keyed by (date, slot)
-    existing = PlannerEntry.query.filter(
-        PlannerEntry.user_id == current_user.id,
-        PlannerEntry.date.in_(days)
-    ).all()
+    existing = owned(PlannerEntry, current_user.id).filter(PlannerEntry.date.in_(days)).all()
     existing_map = {(e.date, e.slot): e for e in existing}
 
     # Create form
     form = PlannerForm()
 
-    # formdata for binding submitted data on POST
-    formdata = request.form if request.method == 'POST' else None
-
     # Dynamically create subforms with prefixes and initial data or POST data
-    for idx, (d, label) in enumerate(slots):
-        prefix = f'slot-{idx}'
-        data = {}
+    for d, label in slots:
         key = (d, label)
+        idx = slot_index_map[key]
+        data = {}
         if key in existing_map:
             e = existing_map[key]
             if e.recipe_id:
@@ -361,113 +461,190 @@ def planner():
             data['free_text'] = ''
             data['notes'] = ''
 
-        subform = PlannerSlotForm(formdata=formdata, prefix=prefix, data=data)
+        subform = PlannerSlotForm(formdata=formdata, prefix=f'slot-{idx}', data=data)
         subform.recipe_id.choices = recipe_choices
 
         setattr(form, f'slot_{idx}', subform)
 
+    return form, slots, slots_by_day, slot_index_map, existing_map
+
+def _planner_entry_values(fld):
+    selected_id = fld.recipe_id.data
+
+    if selected_id == -1:
+        r_id = None
+        text = fld.free_text.data.strip() if fld.free_text.data else None
+    elif selected_id and selected_id > 0:
+        r_id = selected_id
+        text = None
+    else:
+        r_id = None
+        text = None
+
+    notes = fld.notes.data.strip() if fld.notes.data else None
+    return {'recipe_id': r_id, 'free_text': text, 'notes': notes}
+
+def _slot_choices():
+    # Template values for the planner/log recipe dropdowns
+    return {
+        'compact_slots': current_app.config['COMPACT_SLOTS'],
+        'recipe_choices': cached_recipe_choices(current_user),
+        'recipe_labels': recipe_labels(current_user),
+    }
+
+def _recipe_ingredient_lists(recipe_map):
+    # Recipe id -> its ingredient lines, sent once per recipe on compact pages
+    return {
+        r_id: [f'{ri.ingredient.name}: {ri.amount}{ri.ingredient.units}' for ri in r.ingredients]
+        for r_id, r in recipe_map.items()
+    }
+
+def _planner_recipe_map(form, slot_index_map):
+    # Ingredient lists are only shown for the recipes picked in the grid
+    selected_ids = {getattr(form, f'slot_{idx}').recipe_id.data for idx in slot_index_map.values()}
+    return {r.id: r for r in load_recipe_catalog(current_user.id, recipe_ids=selected_ids)}
+
+@main.route('/planner', methods=['GET', 'POST'])
+@login_required
+def planner():
+    start, num_days = _date_window()
+    days = [start + timedelta(days=i) for i in range(num_days)]
+
+    # Targets in force over the window, which set the slots of each day
+    timeline = target_timeline(current_user)
+    if not timeline:
+        flash("Please set your daily targets first.", "warning")
+        return redirect(url_for('main.targets'))
+
+    if request.method == 'POST':
+        form, slots, slots_by_day, slot_index_map, existing_map = _planner_form(
+            _posted_days(days), timeline, formdata=request.form)
+    else:
+        form, slots, slots_by_day, slot_index_map, existing_map = _planner_form(days[:PAGE_DAYS], timeline)
+
     if form.validate_on_submit():
-        for idx, (d, label) in enumerate(slots):
-            fld = getattr(form, f'slot_{idx}')
-            selected_id = fld.recipe_id.data
+        for d, label in slots:
             key = (d, label)
-
-            if selected_id == -1:
-                r_id = None
-                text = fld.free_text.data.strip() if fld.free_text.data else None
-            elif selected_id and selected_id > 0:
-                r_id = selected_id
-                text = None
-            else:
-                r_id = None
-                text = None
-            
-            notes = fld.notes.data.strip() if fld.notes.data else None
+            values = _planner_entry_values(getattr(form, f'slot_{slot_index_map[key]}'))
 
             entry = existing_map.get(key)
             if entry:
-                entry.recipe_id = r_id
-                entry.free_text = text
-                entry.notes = notes
+                for field, value in values.items():
+                    setattr(entry, field, value)
             else:
-                entry = PlannerEntry(user_id=current_user.id,
-                                     date=d, slot=label,
-                                     recipe_id=r_id, free_text=text, notes=notes)
+                entry = PlannerEntry(user_id=current_user.id, date=d, slot=label, **values)
                 db.session.add(entry)
 
         db.session.commit()
         flash("Planner saved!", "success")
-        return redirect(url_for('main.planner'))
-    
-    # Aggregate ingredients for all selected (non-custom) recipes in the form
-    ingredient_totals = defaultdict(float)  # key: (ingredient_name, units), value: total_amount
-    ingredient_notes = defaultdict(set)    # key: (ingredient_name, units), value: list of notes
-
-    for idx, (d, label) in enumerate(slots):
-        fld = getattr(form, f'slot_{idx}')
-        selected_id = fld.recipe_id.data
-
-        # Only aggregate if selected recipe is valid and not custom or empty
-        if selected_id and selected_id > 0:
-            recipe = next((r for r in recipes if r.id == selected_id), None)
-            if recipe:
-                for ri in recipe.ingredients:
-                    key = (ri.ingredient.name, ri.ingredient.units)
-                    ingredient_totals[key] += ri.amount
-                    # If unmeasured, collect the slot's notes field
-                    if ri.ingredient.unmeasured_ingredient:
-                        note = fld.notes.data.strip() if fld.notes.data else None
-                        if note:
-                            ingredient_notes[key].add(note)
-
-    used_notes = set()
-    shopping_list = []
-
-    for (name, units), amount in sorted(ingredient_totals.items(), key=lambda x: x[0][0].lower()):
-        notes_for_ingredient = []
-
-        for note in sorted(ingredient_notes[(name, units)]):
-            if note not in used_notes:
-                notes_for_ingredient.append(note)
-                used_notes.add(note)
-
-        shopping_list.append({
-            'name': name,
-            'units': units,
-            'amount': amount,
-            'notes': "; ".join(notes_for_ingredient) if notes_for_ingredient else None
-        })
+        return redirect(url_for('main.planner', **request.args.to_dict()))
+
+    recipe_map = _planner_recipe_map(form, slot_index_map)
+
+    # Aggregate ingredients for every recipe planned in the window
+    shopping_list = build_shopping_list(current_user.id, days[0], days[-1])
 
     return render_template('planner.html',
                            form=form,
                            slots=slots,
                            slots_by_day=slots_by_day,
-                           recipe_map={r.id: r for r in recipes},
+                           recipe_map=recipe_map,
+                           recipe_ingredients=_recipe_ingredient_lists(recipe_map),
                            slot_index_map=slot_index_map,
-                           shopping_list=shopping_list,)
+                           shopping_list=shopping_list,
+                           **_slot_choices(),
+                           **_window_nav(start, num_days))
 
+@main.route('/planner/days', methods=['GET'])
+@login_required
+def planner_days():
+    days, next_start = _fragment_window()
 
-@main.route('/log', methods=['GET', 'POST'])
+    timeline = target_timeline(current_user)
+    if not timeline:
+        abort(404)
+
+    form, slots, slots_by_day, slot_index_map, existing_map = _planner_form(days, timeline)
+    recipe_map = _planner_recipe_map(form, slot_index_map)
+    html = render_template('_planner_days.html',
+                           form=form,
+                           slots_by_day=slots_by_day,
+                           recipe_map=recipe_map,
+                           recipe_ingredients=_recipe_ingredient_lists(recipe_map),
+                           slot_index_map=slot_index_map,
+                           **_slot_choices())
+    return jsonify(html=html, next_start=next_start.isoformat() if next_start else None)
+
+# Labels of the extra meal and snack rows the log adds below a day's planned slots
+EXTRA_SLOT = re.compile(r'Extra (Meal|Snack) \d+')
+SLOT_LENGTH = LogEntry.slot.type.length
+
+def _slot_payload(slot_form_class, allow_extra_slots=False):
+    # Parse and validate a single-slot JSON edit; returns (date, slot, subform) or aborts with a JSON error
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        abort(make_response(jsonify(errors={'body': ['Expected a JSON object.']}), 400))
+
+    try:
+        d = date.fromisoformat(payload.get('date') or '')
+    except (TypeError, ValueError):
+        abort(make_response(jsonify(errors={'date': ['Not a valid date.']}), 400))
+    label = payload.get('slot')
+
+    timeline = target_timeline(current_user)
+    if not timeline:
+        abort(make_response(jsonify(errors={'target': ['Please set your daily targets first.']}), 409))
+
+    valid_labels = {slot for _, slot in timeline.slots([d])}
+    is_extra = (allow_extra_slots and isinstance(label, str) and len(label) <= SLOT_LENGTH
+                and EXTRA_SLOT.fullmatch(label) is not None)
+    if label not in valid_labels and not is_extra:
+        abort(make_response(jsonify(errors={'slot': ['Not a valid slot for this day.']}), 400))
+
+    formdata = MultiDict({k: str(v) for k, v in payload.items() if v is not None and k not in ('date', 'slot')})
+    subform = slot_form_class(formdata=formdata, meta={'csrf': False})
+    subform.recipe_id.choices = cached_recipe_choices(current_user)
+    if not subform.validate():
+        abort(make_response(jsonify(errors=subform.errors), 400))
+
+    return d, label, subform
+
+@main.route('/planner/slot', methods=['PATCH'])
 @login_required
-def log():
-    today = date.today()
-    days = [today + timedelta(days=i) for i in range(10)]
+def planner_slot():
+    d, label, fld = _slot_payload(PlannerSlotForm)
 
-    tgt = Target.query.filter_by(user_id=current_user.id).order_by(Target.date.desc()).first()
-    if not tgt:
-        flash("Please set your daily targets first.", "warning")
-        return redirect(url_for('main.targets'))
+    row = {'user_id': current_user.id, 'date': d, 'slot': label, **_planner_entry_values(fld)}
+    upsert_rows(PlannerEntry, [row], ['user_id', 'date', 'slot'])
+    db.session.commit()
+
+    return jsonify(status='saved', date=d.isoformat(), slot=label)
 
+@main.route('/planner/shopping_list', methods=['GET'])
+@login_required
+def shopping_list():
+    try:
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else date.today()
+    except ValueError:
+        start = date.today()
+    num_days = min(max(request.args.get('days', 14, type=int), 1), 366)
+    end = start + timedelta(days=num_days - 1)
+
+    items = build_shopping_list(current_user.id, start, end)
+
+    return render_template('shopping_list.html',
+                           shopping_list=items,
+                           start=start,
+                           end=end,
+                           num_days=num_days)
+
+def _log_form(days, timeline, formdata=None):
     # Load existing LogEntry records for days
-    existing = LogEntry.query.filter(
-        LogEntry.user_id == current_user.id,
-        LogEntry.date.in_(days)
-    ).all()
+    existing = owned(LogEntry, current_user.id).filter(LogEntry.date.in_(days)).all()
     existing_map = {(e.date, e.slot): e for e in existing}
 
     # Load existing KetoneLogEntry records for days
-    existing_ketones = KetoneLogEntry.query.filter(
-        KetoneLogEntry.user_id == current_user.id,
+    existing_ketones = owned(KetoneLogEntry, current_user.id).filter(
         KetoneLogEntry.date.in_(days)
     ).order_by(KetoneLogEntry.date, KetoneLogEntry.time).all()
 
@@ -475,57 +652,37 @@ def log():
     ketones_by_day = defaultdict(list)
     for k in existing_ketones:
         ketones_by_day[k.date].append(k)
-    print(f"Ketones by day existing: {ketones_by_day}")
-
-    # for day, ketone_list in ketones_by_day.items():
-    #     for ketone in ketone_list:
-    #         print(ketone.date)
-    #         print((type(ketone.time)))
+    current_app.logger.debug('log ketones_by_day=%s', dict(ketones_by_day))
 
     # Compute default slots for meals/snacks
-    slots = []
-    for d in days:
-        for m in range(1, tgt.num_main_meals + 1):
-            label = {1: 'Breakfast', 2: 'Lunch', 3: 'Dinner'}.get(m, f'Meal {m}')
-            slots.append((d, label))
-        for s in range(1, tgt.num_snacks + 1):
-            slots.append((d, f'Snack {s}'))
-    # print(f"Default slots: {slots}")
+    slots = timeline.slots(days)
 
     # Add any existing extra meal/snack slots
     for e in existing:
         if e.slot.startswith("Extra Meal") or e.slot.startswith("Extra Snack"):
             slots.append((e.date, e.slot))
 
-    grouped_slots = defaultdict(list)
-    for d, label in slots:
-        grouped_slots[d].append(label)
-    slots_by_day = sorted(grouped_slots.items())
-    slot_index_map = {key: idx for idx, key in enumerate(slots)}
+    slots_by_day, slot_index_map = group_slots(slots)
 
     # Recipes for choices
-    recipes = Recipe.query.filter_by(user_id=current_user.id).all()
-    recipe_choices = [(0, '-- Select --')] + [(r.id, r.name) for r in recipes] + [(-1, 'CUSTOM')]
+    recipe_choices = cached_recipe_choices(current_user)
 
-    def get_latest_planner_entry(user_id, date_, slot):
-        return PlannerEntry.query.filter(
-            PlannerEntry.user_id == user_id,
-            PlannerEntry.slot == slot,
-            PlannerEntry.date <= date_
-        ).order_by(PlannerEntry.date.desc()).first()
+    # Planner entries to prefill slots that have not been logged yet
+    planned = {} if formdata else effective_planner_entries(
+        current_user.id, [key for key in slots if key not in existing_map])
 
     # Instantiate meal log form
     form = LogForm()
-    formdata = request.form if request.method == 'POST' else None
-    print(f"Form data: {formdata}")
+    current_app.logger.debug('log formdata=%s', formdata)
 
     # Create meal slot subforms dynamically
-    for idx, (d, label) in enumerate(slots):
+    for d, label in slots:
+        key = (d, label)
+        idx = slot_index_map[key]
         prefix = f'slot-{idx}'
         if formdata:
             subform = LogSlotForm(formdata=formdata, prefix=prefix)
         else:
-            key = (d, label)
             data = {}
             if key in existing_map:
                 e = existing_map[key]
@@ -541,7 +698,7 @@ def log():
                 data['percent_eaten'] = e.percent_eaten or 100
                 data['notes'] = e.notes or ''
             else:
-                planner = get_latest_planner_entry(current_user.id, d, label)
+                planner = planned.get(key)
                 if planner:
                     if planner.recipe_id:
                         data['recipe_id'] = planner.recipe_id
@@ -556,6 +713,47 @@ def log():
         subform.recipe_id.choices = recipe_choices
         setattr(form, f'slot_{idx}', subform)
 
+    return form, slots, slots_by_day, slot_index_map, existing_map, existing_ketones, ketones_by_day
+
+def _log_entry_values(fld):
+    selected_id = fld.recipe_id.data
+
+    if selected_id == -1:
+        # Free-text meals have no recipe; the text alone marks them as custom
+        r_id = None
+        text = fld.free_text.data.strip() if fld.free_text.data else None
+    elif selected_id and selected_id > 0:
+        r_id = selected_id
+        text = None
+    else:
+        r_id = None
+        text = None
+
+    percent = fld.percent_eaten.data if fld.percent_eaten.data is not None else 100
+    notes = fld.notes.data.strip() if fld.notes.data else None
+    return {'recipe_id': r_id, 'free_text': text, 'percent_eaten': percent, 'notes': notes}
+
+def _ketone_row_count(slots_by_day, ketones_by_day):
+    # Each day renders its saved readings, or one blank row when it has none
+    return sum(max(len(ketones_by_day.get(d, [])), 1) for d, _ in slots_by_day)
+
+@main.route('/log', methods=['GET', 'POST'])
+@login_required
+def log():
+    start, num_days = _date_window()
+    days = [start + timedelta(days=i) for i in range(num_days)]
+
+    timeline = target_timeline(current_user)
+    if not timeline:
+        flash("Please set your daily targets first.", "warning")
+        return redirect(url_for('main.targets'))
+
+    if request.method == 'POST':
+        form, slots, slots_by_day, slot_index_map, existing_map, existing_ketones, ketones_by_day = _log_form(
+            _posted_days(days), timeline, formdata=request.form)
+    else:
+        form, slots, slots_by_day, slot_index_map, existing_map, existing_ketones, ketones_by_day = _log_form(
+            days[:PAGE_DAYS], timeline)
     # On POST: handle adding extra meal/snack button clicks
     if request.method == 'POST':
         action = request.form.get('action')
@@ -580,74 +778,32 @@ def log():
                     )
                     db.session.add(new_entry)
                     db.session.commit()
-                return redirect(url_for('main.log'))
+                return redirect(url_for('main.log', **request.args.to_dict()))
 
         # Handle "Save Log" submission including ketones
-        print("Got to save log")
-        print(f"Form errors: {form.errors}")
-        print(f"Request method: {request.method}")
-        print(f"Form is submitted: {form.is_submitted()}")
-        print(f"Request form data: {request.form}")
-        print("Manual validation:", form.validate())
-        # for ketone_entry in form.ketone_entries:
-        #     print(f"Ketone entry data: {ketone_entry.form.data}")
-
-        from flask_wtf.csrf import CSRFError
-        try:
-            valid = form.validate()
-        except CSRFError as e:
-            print("CSRF validation error:", e.description)
-            valid = False
-        print("Form validate() result:", valid)
-        print("Form errors:", form.errors)
-
-        for i in range(10):
-            print(request.form.get(f'ketone_entries-{i}-time'))
-
         if form.validate_on_submit():
-            print(f"form data 2: {formdata}")
-            print(f"form ketone entries: {form.ketone_entries.entries}")
             # Save meal log entries
-            for idx, (d, label) in enumerate(slots):
-                fld = getattr(form, f'slot_{idx}')
-                selected_id = fld.recipe_id.data
+            for d, label in slots:
                 key = (d, label)
-
-                if selected_id == -1:
-                    r_id = -1
-                    text = fld.free_text.data.strip() if fld.free_text.data else None
-                elif selected_id and selected_id > 0:
-                    r_id = selected_id
-                    text = None
-                else:
-                    r_id = None
-                    text = None
-
-                percent = fld.percent_eaten.data if fld.percent_eaten.data is not None else 100
-                notes = fld.notes.data.strip() if fld.notes.data else None
+                values = _log_entry_values(getattr(form, f'slot_{slot_index_map[key]}'))
 
                 entry = existing_map.get(key)
                 if entry:
-                    entry.recipe_id = r_id
-                    entry.free_text = text
-                    entry.percent_eaten = percent
-                    entry.notes = notes
+                    for field, value in values.items():
+                        setattr(entry, field, value)
                 else:
-                    entry = LogEntry(
-                        user_id=current_user.id,
-                        date=d,
-                        slot=label,
-                        recipe_id=r_id,
-                        free_text=text,
-                        percent_eaten=percent,
-                        notes=notes
-                    )
+                    entry = LogEntry(user_id=current_user.id, date=d, slot=label, **values)
                     db.session.add(entry)
+            refresh_summaries(current_user.id, dates={d for d, _ in slots})
 
             ketone_entries = []
+            submitted_pairs = set()
             for entry in form.ketone_entries.entries:
+                if not (entry.form.date.data and entry.form.time.data):
+                    continue
                 d = date.fromisoformat(entry.form.date.data)
                 t = entry.form.time.data
+                submitted_pairs.add((d, t))
 
                 ketones = entry.form.ketone_level.data
                 glucose = entry.form.glucose_level.data
@@ -655,83 +811,171 @@ def log():
                 if ketones is None and glucose is None:
                     continue
 
-                ketone_entries.append((d, t, ketones, glucose))
+                ketone_entries.append({
+                    'user_id': current_user.id,
+                    'date': d,
+                    'time': t,
+                    'ketone_level': ketones,
+                    'glucose_level': glucose,
+                })
 
+            current_app.logger.debug('log ketone_entries=%s', ketone_entries)
 
-            print(f"ketone_entries: {ketone_entries}")
+            # Save ketone log entries, overwriting existing ones that have the same date and time
+            upsert_rows(KetoneLogEntry, ketone_entries, ['user_id', 'date', 'time'])
 
-            # Save ketone log entries, overwrinting existing ones that have the same date and time
-            for d, t, ketones, glucose in ketone_entries:
-                existing_entry = KetoneLogEntry.query.filter_by(
-                    user_id=current_user.id,
-                    date=d,
-                    time=t
-                ).first()
-                print(f"Existing entry: {existing_entry}")
-                if ketones is None and glucose is None:
-                    continue
-                if existing_entry:
-                    existing_entry.ketone_level = ketones
-                    existing_entry.glucose_level = glucose
-                else:
-                    new_k = KetoneLogEntry(
-                        user_id=current_user.id,
-                        date=d,
-                        time=t,
-                        ketone_level=ketones,
-                        glucose_level=glucose
-                    )
-                    db.session.add(new_k)
+            # Delete readings in the displayed window that were not submitted (due to the remove button)
+            stale_ids = [k.id for k in existing_ketones if (k.date, k.time) not in submitted_pairs]
+            if stale_ids:
+                (owned(KetoneLogEntry, current_user.id).filter(KetoneLogEntry.id.in_(stale_ids))
+                 .delete(synchronize_session=False))
 
-            # Handle deletion of ketone entries not submitted in the form (due to the remove button)
-            submitted_pairs = set()
-            idx = 0
-
-            # Collect all (date, time) pairs submitted
-            while True:
-                date_key = f'ketone_entries-{idx}-date'
-                time_key = f'ketone_entries-{idx}-time'
-                if date_key not in request.form or time_key not in request.form:
-                    break
-
-                date_str = request.form.get(date_key)
-                time_str = request.form.get(time_key)
-                if not (date_str and time_str):
-                    idx += 1
-                    continue
+            db.session.commit()
+            flash("Log saved!", "success")
+            return redirect(url_for('main.log', **request.args.to_dict()))
 
-                date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-                time_obj = datetime.strptime(time_str, '%H:%M').time()
-                submitted_pairs.add((date_obj, time_obj))
+        current_app.logger.debug('log save rejected errors=%s', form.errors)
 
-                idx += 1
+    return render_template('log.html',
+                           form=form,
+                           slots=slots,
+                           slots_by_day=slots_by_day,
+                           slot_index_map=slot_index_map,
+                           ketones_by_day=ketones_by_day,
+                           ketone_offset=0,
+                           ketone_count=_ketone_row_count(slots_by_day, ketones_by_day),
+                           **_slot_choices(),
+                           **_window_nav(start, num_days))
 
-            # Now fetch all existing entries for the user
-            existing_entries = KetoneLogEntry.query.filter_by(user_id=current_user.id).all()
+@main.route('/log/readings/import', methods=['GET', 'POST'])
+@login_required
+def import_readings_upload():
+    form = ReadingsImportForm()
+    report = None
+    if form.validate_on_submit():
+        upload = form.file.data
+        try:
+            report = import_readings(current_user.id, upload.stream, format_for(upload.filename))
+        except ValueError as e:
+            flash(str(e), 'danger')
+        else:
+            if report.inserted or report.updated:
+                flash(f'Imported {report.inserted} new readings and updated {report.updated}.', 'success')
 
-            # Delete any existing entries NOT in submitted form
-            for entry in existing_entries:
-                if (entry.date, entry.time) not in submitted_pairs:
-                    db.session.delete(entry)
+    return render_template('import_readings.html', form=form, report=report)
 
-            db.session.commit()
-            flash("Log saved!", "success")
-            return redirect(url_for('main.log'))
+@main.route('/log/slot', methods=['PATCH'])
+@login_required
+def log_slot():
+    d, label, fld = _slot_payload(LogSlotForm, allow_extra_slots=True)
 
-    return render_template('log.html',
+    row = {'user_id': current_user.id, 'date': d, 'slot': label, **_log_entry_values(fld)}
+    upsert_rows(LogEntry, [row], ['user_id', 'date', 'slot'])
+    refresh_summaries(current_user.id, dates=[d])
+    db.session.commit()
+
+    return jsonify(status='saved', date=d.isoformat(), slot=label)
+
+@main.route('/log/days', methods=['GET'])
+@login_required
+def log_days():
+    days, next_start = _fragment_window()
+
+    timeline = target_timeline(current_user)
+    if not timeline:
+        abort(404)
+
+    form, slots, slots_by_day, slot_index_map, existing_map, existing_ketones, ketones_by_day = _log_form(days, timeline)
+    # Ketone rows are numbered across the whole page, so continue from the client's counter
+    ketone_offset = request.args.get('ketone_offset', 0, type=int)
+    html = render_template('_log_days.html',
                            form=form,
-                           slots=slots,
                            slots_by_day=slots_by_day,
-                           recipe_map={r.id: r for r in recipes},
                            slot_index_map=slot_index_map,
-                           ketones_by_day=ketones_by_day)
+                           ketones_by_day=ketones_by_day,
+                           ketone_offset=ketone_offset,
+                           **_slot_choices())
+    return jsonify(html=html,
+                   next_start=next_start.isoformat() if next_start else None,
+                   ketone_offset=ketone_offset + _ketone_row_count(slots_by_day, ketones_by_day))
+
+@main.route('/log/summary', methods=['GET'])
+@login_required
+def log_summary():
+    # A month of daily totals (the current month by default), or with only ?year= the year by month
+    today = date.today()
+    year = request.args.get('year', today.year, type=int)
+    month = request.args.get('month', None if 'year' in request.args else today.month, type=int)
+    if not 1 < year < 9999 or (month is not None and not 1 <= month <= 12):
+        abort(404)
+
+    if month is None:
+        return render_template('log_summary.html', year=year, month=None,
+                               months=year_summaries(current_user.id, year))
+
+    prev_month = (year, month - 1) if month > 1 else (year - 1, 12)
+    next_month = (year, month + 1) if month < 12 else (year + 1, 1)
+    return render_template('log_summary.html', year=year, month=month,
+                           days=month_summaries(current_user.id, year, month),
+                           prev_month=prev_month, next_month=next_month)
+
+@main.route('/export/<kind>.<fmt>', methods=['GET'])
+@login_required
+def export(kind, fmt):
+    if kind not in EXPORTS or fmt not in FORMATS:
+        abort(404)
+    try:
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else None
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else None
+    except ValueError:
+        abort(400)
+
+    filename = f'keto-buddy-{kind}-{date.today().isoformat()}.{fmt}'
+    # stream_with_context keeps the request (and its DB session) open while the rows are sent
+    return Response(
+        stream_with_context(export_chunks(kind, fmt, current_user.id, start, end)),
+        mimetype=FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
 
 @main.route('/fruit_substitutions', methods=['GET'])
 @login_required
+@static_page
 def fruit_substitutions():
-    return render_template('fruit_substitutions.html')
+    return page_cache.page('fruit_substitutions.html', lambda: render_template('fruit_substitutions.html'))
 
 @main.route('/veg_substitutions', methods=['GET'])
 @login_required
+@static_page
 def veg_substitutions():
-    return render_template('veg_substitutions.html')
\ No newline at end of file
+    return page_cache.page('veg_substitutions.html', lambda: render_template('veg_substitutions.html'))
+
+@main.route('/metrics', methods=['GET'])
+@login_required
+@admin_required
+def metrics():
+    return jsonify(request_metrics.snapshot())
+
+@main.route('/profiles', methods=['GET'])
+@login_required
+@admin_required
+def profiles():
+    return render_template('profiles.html', profiles=list_profiles(current_app.config['PROFILE_DIR']))
+
+@main.route('/profiles/<profile_id>', methods=['GET'])
+@login_required
+@admin_required
+def profile_detail(profile_id):
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in ('cumulative', 'tottime', 'ncalls'):
+        sort = 'cumulative'
+    report = profile_report(current_app.config['PROFILE_DIR'], profile_id, sort=sort)
+    if report is None:
+        abort(404)
+    return render_template('profile.html', profile_id=profile_id, report=report, sort=sort)
+
+@main.route('/profiles/<profile_id>/download', methods=['GET'])
+@login_required
+@admin_required
+def profile_download(profile_id):
+    return send_from_directory(current_app.config['PROFILE_DIR'], f'{profile_id}.prof', as_attachment=True)
@@ -0,0 +1,91 @@
+# Ingredient search for the recipe pages' autocomplete.
+#
+# IngredientIndex is an in-memory prefix index over one user's ingredients: a sorted list of
+# (word, ingredient id) for every word of each ingredient's name and source, so the ingredients with a
+# word starting with a given prefix are one bisect away. It is built once per data version by
+# cache.ingredient_index and shared by every request until the user's ingredients change.
+
+import re
+from bisect import bisect_left
+from heapq import nsmallest
+
+WORD = re.compile(r'\w+')
+MAX_RESULTS = 50
+
+def _words(text):
+    return WORD.findall(text.lower())
+
+class IngredientIndex:
+    def __init__(self, rows):
+        # rows: (id, name, source, units, percent_fat, percent_carbs, percent_protein, total_calories,
+        # unmeasured_ingredient) tuples
+        self.entries = {}
+        self._names = {}
+        self.labels = {}  # id -> label, for every ingredient
+        self.measured_labels = {}  # id -> label, leaving out unmeasured fruit/veg groups
+        words = []
+        for ing_id, name, source, units, fat, carbs, protein, calories, unmeasured in rows:
+            label = f'{name} ({source})' if source else name
+            self.entries[ing_id] = {
+                'id': ing_id,
+                'label': label,
+                'units': units,
+                'percent_fat': fat,
+                'percent_carbs': carbs,
+                'percent_protein': protein,
+                'total_calories': calories,
+                'measured': not unmeasured,
+            }
+            self._names[ing_id] = name.lower()
+            self.labels[ing_id] = label
+            if not unmeasured:
+                self.measured_labels[ing_id] = label
+            words.extend((word, ing_id) for word in set(_words(label)))
+        words.sort()
+        self._words = words
+
+    def _prefixed(self, prefix):
+        # Ids of ingredients with a word starting with prefix
+        ids = set()
+        i = bisect_left(self._words, (prefix,))
+        while i < len(self._words) and self._words[i][0].startswith(prefix):
+            ids.add(self._words[i][1])
+            i += 1
+        return ids
+
+    def _rank(self, ing_id, query, terms):
+        # Exact names first, then names starting with the query, then names whose first word
+        # matches the first term, then everything else; shorter names first within each group
+        name = self._names[ing_id]
+        if name == query:
+            group = 0
+        elif name.startswith(query):
+            group = 1
+        elif name.startswith(terms[0]):
+            group = 2
+        else:
+            group = 3
+        return group, len(name), name, ing_id
+
+    def search(self, query, limit=20, measured_only=False):
+        # Best matches for what has been typed so far; every word typed must start a word of the
+        # ingredient's name or source. An empty query lists ingredients alphabetically.
+        limit = max(1, min(limit, MAX_RESULTS))
+        query = ' '.join(_words(query))
+        terms = query.split()
+        if terms:
+            ids = self._prefixed(terms[0])
+            for term in terms[1:]:
+                if not ids:
+                    break
+                ids &= self._prefixed(term)
+        else:
+            ids = self.entries.keys()
+        if measured_only:
+            ids = [i for i in ids if self.entries[i]['measured']]
+
+        if terms:
+            best = nsmallest(limit, ids, key=lambda i: self._rank(i, query, terms))
+        else:
+            best = nsmallest(limit, ids, key=lambda i: (self._names[i], i))
+        return [self.entries[i] for i in best]
@@ -1,5 +1,6 @@
 from . import db
 from .models import Ingredient
+from .queries import owned
 
 def seed_ingredients(user_id):
     special_ingredients = [
@@ -54,7 +55,7 @@ def seed_ingredients(user_id):
     ]
 
     for item in special_ingredients:
-        exists = Ingredient.query.filter_by(name=item['name']).first()
+        exists = owned(Ingredient, user_id).filter_by(name=item['name']).first()
         if not exists:
             ingredient = Ingredient(**item)
             db.session.add(ingredient)
@@ -0,0 +1,57 @@
+from sqlalchemy import func
+
+from .models import Ingredient, PlannerEntry, RecipeIngredient
+from .queries import owned
+
+def build_shopping_list(user_id, start, end):
+    # Ingredient totals for every recipe planned between start and end (inclusive), summed in SQL
+    totals = (
+        owned(PlannerEntry, user_id)
+        .with_entities(Ingredient.name, Ingredient.units, func.sum(RecipeIngredient.amount))
+        .join(RecipeIngredient, RecipeIngredient.ingredient_id == Ingredient.id)
+        .join(PlannerEntry, PlannerEntry.recipe_id == RecipeIngredient.recipe_id)
+        .filter(PlannerEntry.date.between(start, end))
+        .group_by(Ingredient.name, Ingredient.units)
+        .all()
+    )
+
+    # Unmeasured ingredients (fruit/veg groups) pick up the notes of the slots they were planned in
+    note_rows = (
+        owned(PlannerEntry, user_id)
+        .with_entities(Ingredient.name, Ingredient.units, PlannerEntry.notes)
+        .join(RecipeIngredient, RecipeIngredient.ingredient_id == Ingredient.id)
+        .join(PlannerEntry, PlannerEntry.recipe_id == RecipeIngredient.recipe_id)
+        .filter(
+            PlannerEntry.date.between(start, end),
+            Ingredient.unmeasured_ingredient.is_(True),
+            PlannerEntry.notes.isnot(None)
+        )
+        .distinct()
+        .all()
+    )
+    ingredient_notes = {}
+    for name, units, note in note_rows:
+        note = note.strip()
+        if note:
+            ingredient_notes.setdefault((name, units), set()).add(note)
+
+    # Each note is listed once, against the first ingredient (alphabetically) that uses it
+    used_notes = set()
+    items = []
+
+    for name, units, amount in sorted(totals, key=lambda row: row[0].lower()):
+        notes_for_ingredient = []
+
+        for note in sorted(ingredient_notes.get((name, units), ())):
+            if note not in used_notes:
+                notes_for_ingredient.append(note)
+                used_notes.add(note)
+
+        items.append({
+            'name': name,
+            'units': units,
+            'amount': amount,
+            'notes': "; ".join(notes_for_ingredient) if notes_for_ingredient else None
+        })
+
+    return items
@@ -0,0 +1,126 @@
+# Daily intake summaries: the fat, carbs, protein and calories eaten each day, worked out from the log
+# (each entry's recipe totals times the percent eaten), stored as one DailySummary row per user and day.
+#
+# refresh_summaries recomputes a set of days with one aggregate query and one upsert, in the same
+# transaction as whatever changed them: log saves, recipe recomputes and new targets. The month and
+# year adherence pages read these rows (at most a year's worth) instead of every log entry, and the
+# backfill-summaries command builds them for history logged before they existed.
+
+from datetime import date
+
+from sqlalchemy import and_, case, extract, func, select
+
+from . import db
+from .models import DailySummary, LogEntry, Recipe
+from .nutrition import ketogenic_ratio
+from .queries import owned, upsert_rows
+from .timeline import TargetTimeline
+
+CALORIE_TOLERANCE = 0.10  # a day is on target within 10% of the target calories...
+RATIO_TOLERANCE = 0.10  # ...and of the target ratio
+
+def _on_target(calories, ratio, target):
+    if target is None or ratio is None or not target.calories:
+        return False
+    target_ratio = float(target.ratio)
+    return (abs(calories - target.calories) <= CALORIE_TOLERANCE * target.calories
+            and abs(ratio - target_ratio) <= RATIO_TOLERANCE * target_ratio)
+
+def refresh_summaries(user_id, dates=None, since=None, recipe_ids=None):
+    # Recompute the user's summaries for the given dates, every day from since onwards, or the days
+    # whose log uses any of recipe_ids; with none of these, the whole history. Days with nothing
+    # eaten lose their row. Returns the number of days stored; the caller commits.
+    if (dates is not None and not dates) or (recipe_ids is not None and not recipe_ids):
+        return 0
+
+    def scoped(query, column):
+        if dates is not None:
+            query = query.filter(column.in_(set(dates)))
+        if since is not None:
+            query = query.filter(column >= since)
+        if recipe_ids is not None:
+            query = query.filter(column.in_(
+                select(LogEntry.date).where(LogEntry.user_id == user_id, LogEntry.recipe_id.in_(set(recipe_ids)))
+            ))
+        return query
+
+    fraction = func.coalesce(LogEntry.percent_eaten, 100) / 100.0
+    totals = scoped(
+        db.session.query(
+            LogEntry.date,
+            func.coalesce(func.sum(Recipe.total_fat * fraction), 0),
+            func.coalesce(func.sum(Recipe.total_carbs * fraction), 0),
+            func.coalesce(func.sum(Recipe.total_protein * fraction), 0),
+            func.coalesce(func.sum(Recipe.total_calories * fraction), 0),
+            func.count(Recipe.id),
+            # Free-text meals have text but no recipe
+            func.sum(case((and_(LogEntry.recipe_id.is_(None), LogEntry.free_text != ''), 1), else_=0)),
+        )
+        .outerjoin(Recipe, (Recipe.id == LogEntry.recipe_id) & (Recipe.user_id == user_id))
+        .filter(LogEntry.user_id == user_id),
+        LogEntry.date
+    ).group_by(LogEntry.date).all()
+
+    # Loaded afresh rather than from the reference cache, as the caller may have just added a target
+    timeline = TargetTimeline.load(user_id, breakdowns=False)
+    rows = []
+    for d, fat, carbs, protein, calories, meals, custom in totals:
+        if not meals and not custom:
+            continue
+        target = timeline.at(d)
+        ratio = ketogenic_ratio(fat, carbs, protein)
+        rows.append({
+            'user_id': user_id,
+            'date': d,
+            'fat': round(fat, 1),
+            'carbs': round(carbs, 1),
+            'protein': round(protein, 1),
+            'calories': round(calories, 1),
+            'ratio': round(ratio, 2) if ratio is not None else None,
+            'meals_logged': meals,
+            'custom_meals': custom,
+            'target_id': target.id if target else None,
+            'target_calories': target.calories if target else None,
+            'target_ratio': float(target.ratio) if target else None,
+            'on_target': _on_target(calories, ratio, target),
+        })
+
+    # Rows of days whose entries were all cleared. Days using one of recipe_ids still have a meal, and of
+    # a list of dates only those missing from the totals can have been cleared.
+    kept = {row['date'] for row in rows}
+    cleared = scoped(owned(DailySummary, user_id), DailySummary.date)
+    if dates is not None and set(dates) - kept:
+        cleared.filter(DailySummary.date.in_(set(dates) - kept)).delete(synchronize_session=False)
+    elif dates is None and recipe_ids is None:
+        cleared.filter(DailySummary.date.notin_(kept)).delete(synchronize_session=False)
+    upsert_rows(DailySummary, rows, ['user_id', 'date'])
+    return len(rows)
+
+def month_summaries(user_id, year, month):
+    # The month's DailySummary rows, in date order
+    start = date(year, month, 1)
+    end = date(year + month // 12, month % 12 + 1, 1)
+    return (
+        owned(DailySummary, user_id)
+        .filter(DailySummary.date >= start, DailySummary.date < end)
+        .order_by(DailySummary.date)
+        .all()
+    )
+
+def year_summaries(user_id, year):
+    # One aggregate row per month with anything logged: (month, days, average fat, carbs, protein,
+    # calories and ratio, days on target)
+    month = extract('month', DailySummary.date)
+    return (
+        owned(DailySummary, user_id)
+        .with_entities(
+            month, func.count(DailySummary.id),
+            func.avg(DailySummary.fat), func.avg(DailySummary.carbs), func.avg(DailySummary.protein),
+            func.avg(DailySummary.calories), func.avg(DailySummary.ratio),
+            func.sum(case((DailySummary.on_target, 1), else_=0)),
+        )
+        .filter(DailySummary.date >= date(year, 1, 1), DailySummary.date < date(year + 1, 1, 1))
+        .group_by(month)
+        .order_by(month)
+        .all()
+    )
@@ -0,0 +1,145 @@
+# Synthetic data for benchmarking against a realistically sized database.
+#
+# Each generated family gets a target, a pantry of ingredients, recipes built from them (with totals
+# filled in by the same recompute used for edited ingredients), and a history of planner, log and
+# ketone rows. Rows go in as chunked executemany INSERTs, one commit per family.
+
+import random
+from datetime import date, time, timedelta
+
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+
+from . import db
+from .models import (
+    Ingredient, Recipe, RecipeIngredient, Target, TargetBreakdown, Users, PlannerEntry, LogEntry, KetoneLogEntry)
+from .nutrition import recompute_recipes
+
+CHUNK_SIZE = 5000
+
+FOODS = {
+    'fats_oils': ['Butter', 'Olive oil', 'Coconut oil', 'Ghee', 'Mayonnaise'],
+    'dairy': ['Double cream', 'Cheddar', 'Cream cheese', 'Greek yoghurt', 'Mascarpone'],
+    'meats_fishes': ['Chicken thigh', 'Salmon', 'Bacon', 'Egg', 'Beef mince'],
+    'nuts_seeds': ['Almonds', 'Macadamias', 'Walnuts', 'Chia seeds', 'Pecans'],
+    'vegetables': ['Spinach', 'Broccoli', 'Cauliflower', 'Courgette', 'Cucumber'],
+    'fruit': ['Strawberries', 'Raspberries', 'Blueberries', 'Blackberries', 'Avocado'],
+    'carbohydrates': ['Oat bran', 'Rice', 'Bread', 'Pasta', 'Potato'],
+}
+MEAL_LABELS = ['Breakfast', 'Lunch', 'Dinner']
+KETONE_TIMES = [time(7, 30), time(12, 0), time(18, 30)]
+
+def _insert_chunks(model, rows):
+    for i in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(insert(model), rows[i:i + CHUNK_SIZE])
+
+def _ingredient_rows(rnd, user_id, count):
+    rows = []
+    kinds = list(FOODS.items())
+    for n in range(count):
+        kind, names = kinds[n % len(kinds)]
+        fat = round(rnd.uniform(0, 99 if kind == 'fats_oils' else 40), 1)
+        carbs = round(rnd.uniform(0, 60 if kind == 'carbohydrates' else 10), 1)
+        protein = round(rnd.uniform(0, 30), 1)
+        rows.append({
+            'user_id': user_id,
+            'name': f'{rnd.choice(names)} {n + 1}',
+            'type': kind,
+            'units': 'ml' if kind == 'fats_oils' and n % 2 else 'g',
+            'percent_fat': fat,
+            'percent_carbs': carbs,
+            'percent_protein': protein,
+            'total_calories': round(9 * fat + 4 * carbs + 4 * protein, 1),
+            'source': rnd.choice(['Tesco', 'Sainsbury\'s', 'Hospital', None]),
+            'unmeasured_ingredient': False,
+        })
+    return rows
+
+def _generate_user(rnd, n, password_hash, prefix, num_recipes, num_ingredients, ingredients_per_recipe,
+                   num_days, today):
+    user = Users(childsname=f'{prefix}-{n}', email=f'{prefix}-{n}@example.com', password_hash=password_hash)
+    db.session.add(user)
+    db.session.flush()
+
+    first_day = today - timedelta(days=num_days - 1)
+    target = Target(user_id=user.id, ratio=3, calories=1200, fat=112, protein=25, carbs=12,
+                    date=first_day, num_main_meals=3, num_snacks=2)
+    db.session.add(target)
+    db.session.flush()
+    db.session.add_all([
+        TargetBreakdown(user_id=user.id, item='Meal', calories=300, fat=28, protein=6, carbs=3,
+                        date=first_day, target_id=target.id),
+        TargetBreakdown(user_id=user.id, item='Snack', calories=150, fat=14, protein=3, carbs=1.5,
+                        date=first_day, target_id=target.id),
+    ])
+
+    ingredient_ids = db.session.scalars(
+        insert(Ingredient).returning(Ingredient.id, sort_by_parameter_order=True),
+        _ingredient_rows(rnd, user.id, num_ingredients)
+    ).all()
+
+    recipe_ids = db.session.scalars(
+        insert(Recipe).returning(Recipe.id, sort_by_parameter_order=True),
+        [{
+            'user_id': user.id,
+            'name': f'Recipe {r + 1}',
+            'author': rnd.choice(['home', 'hospital']),
+            'meal_type': rnd.choice(['breakfast', 'main', 'snack']),
+            'notes': None,
+        } for r in range(num_recipes)]
+    ).all()
+
+    # Per-row macros are placeholders until recompute_recipes fills them from the ingredients
+    _insert_chunks(RecipeIngredient, [
+        {'recipe_id': recipe_id, 'ingredient_id': ingredient_id, 'amount': round(rnd.uniform(5, 60), 1),
+         'fat': 0.0, 'carbs': 0.0, 'protein': 0.0, 'calories': 0.0}
+        for recipe_id in recipe_ids
+        for ingredient_id in rnd.sample(ingredient_ids, min(ingredients_per_recipe, len(ingredient_ids)))
+    ])
+    recompute_recipes(user_id=user.id)
+
+    slots = MEAL_LABELS + ['Snack 1', 'Snack 2']
+    planner_rows, log_rows, ketone_rows = [], [], []
+    for offset in range(num_days):
+        d = first_day + timedelta(days=offset)
+        for label in slots:
+            # Plans are entered roughly weekly and carry forward to the following days
+            if offset % 7 == 0:
+                planner_rows.append({'user_id': user.id, 'date': d, 'slot': label,
+                                     'recipe_id': rnd.choice(recipe_ids), 'free_text': None, 'notes': None})
+            custom = rnd.random() < 0.05
+            log_rows.append({
+                'user_id': user.id, 'date': d, 'slot': label,
+                'recipe_id': None if custom else rnd.choice(recipe_ids),
+                'free_text': 'Ate out' if custom else None,
+                'percent_eaten': rnd.choice([100, 100, 100, 75, 50]),
+                'notes': None,
+            })
+        for t in rnd.sample(KETONE_TIMES, rnd.randint(1, len(KETONE_TIMES))):
+            ketone_rows.append({'user_id': user.id, 'date': d, 'time': t,
+                                'ketone_level': round(rnd.uniform(1.5, 5.5), 1),
+                                'glucose_level': round(rnd.uniform(3.5, 6.0), 1) if rnd.random() < 0.3 else None})
+
+    _insert_chunks(PlannerEntry, planner_rows)
+    _insert_chunks(LogEntry, log_rows)
+    _insert_chunks(KetoneLogEntry, ketone_rows)
+    db.session.commit()
+    return user.id
+
+def generate(num_users, num_recipes, num_ingredients, num_days, ingredients_per_recipe=5, prefix='bench',
+             password='bench', seed=0, progress=None):
+    # Returns the ids of the generated users; they can log in as <prefix>-<n> with the given password
+    rnd = random.Random(seed)
+    password_hash = generate_password_hash(password)
+    today = date.today()
+
+    # Continue numbering after any families left by an earlier run with the same prefix
+    first = Users.query.filter(Users.childsname.like(f'{prefix}-%')).count() + 1
+
+    user_ids = []
+    for n in range(first, first + num_users):
+        user_ids.append(_generate_user(rnd, n, password_hash, prefix, num_recipes, num_ingredients,
+                                       ingredients_per_recipe, num_days, today))
+        if progress:
+            progress(len(user_ids), num_users)
+    return user_ids
@@ -0,0 +1,107 @@
+# Which target applied on a given day.
+#
+# A user's targets are versioned by date: saving new targets adds a row dated today and leaves the
+# old ones in place. TargetTimeline holds them all in date order (two column queries, one for the
+# targets and one for their breakdowns), and the target in force on a day is the last one set on or
+# before it, found by bisecting the dates. The planner, log and summaries look up every day of a
+# window against the same timeline, so older days keep the targets they were planned and eaten
+# against. The timeline also lays out the meal and snack slots those windows show for each day.
+
+from bisect import bisect_right
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date
+from decimal import Decimal
+
+from .models import Target, TargetBreakdown
+from .queries import owned
+
+@dataclass(frozen=True)
+class Breakdown:
+    item: str  # 'Meal' or 'Snack'
+    calories: float
+    fat: float
+    protein: float
+    carbs: float
+
+@dataclass(frozen=True)
+class TargetVersion:
+    id: int
+    date: date
+    ratio: Decimal
+    calories: float
+    fat: float
+    protein: float
+    carbs: float
+    num_main_meals: int
+    num_snacks: int
+    breakdowns: tuple = ()
+
+class TargetTimeline:
+    def __init__(self, targets):
+        # targets: TargetVersions in (date, id) order, so the last of several set on one day wins
+        self.targets = targets
+        self._dates = [t.date for t in targets]
+
+    @classmethod
+    def load(cls, user_id, breakdowns=True):
+        rows = (
+            owned(Target, user_id)
+            .with_entities(Target.id, Target.date, Target.ratio, Target.calories, Target.fat, Target.protein,
+                           Target.carbs, Target.num_main_meals, Target.num_snacks)
+            .order_by(Target.date, Target.id)
+            .all()
+        )
+        by_target = {}
+        if breakdowns and rows:
+            for target_id, *values in (
+                owned(TargetBreakdown, user_id)
+                .with_entities(TargetBreakdown.target_id, TargetBreakdown.item, TargetBreakdown.calories,
+                               TargetBreakdown.fat, TargetBreakdown.protein, TargetBreakdown.carbs)
+                .order_by(TargetBreakdown.id)
+            ):
+                by_target.setdefault(target_id, []).append(Breakdown(*values))
+        return cls([TargetVersion(*row, breakdowns=tuple(by_target.get(row[0], ()))) for row in rows])
+
+    def __bool__(self):
+        return bool(self.targets)
+
+    @property
+    def latest(self):
+        return self.targets[-1] if self.targets else None
+
+    def at(self, d):
+        # The target in force on d. Days before the first target use the first, as the planner and log
+        # still need slots for them.
+        if not self.targets:
+            return None
+        return self.targets[max(bisect_right(self._dates, d) - 1, 0)]
+
+    def for_dates(self, dates):
+        # {date: target in force} for every date given
+        return {d: self.at(d) for d in dates}
+
+    def slots(self, days):
+        # (date, label) of every slot: each day gets the meals and snacks of the target in force on it
+        slots = []
+        for d, tgt in self.for_dates(days).items():
+            for m in range(1, tgt.num_main_meals + 1):
+                label = {1: 'Breakfast', 2: 'Lunch', 3: 'Dinner'}.get(m, f'Meal {m}')
+                slots.append((d, label))
+            for s in range(1, tgt.num_snacks + 1):
+                slots.append((d, f'Snack {s}'))
+        return slots
+
+def group_slots(slots):
+    grouped_slots = defaultdict(list)
+    for d, label in slots:
+        grouped_slots[d].append(label)
+    slots_by_day = sorted(grouped_slots.items())
+
+    # Subform keys are built from the date so each day renders independently of the rest of the window
+    slot_index_map = {
+        (d, label): f'{d.isoformat()}-{n}'
+        for d, labels in slots_by_day
+        for n, label in enumerate(labels)
+    }
+    return slots_by_day, slot_index_map
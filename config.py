@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 from dotenv import load_dotenv
 
@@ -17,3 +18,41 @@ class Config:
     # SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'keto.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SECRET_KEY = os.environ.get('FLASK_SECRET_KEY')
+
+    # Number of per-user ingredient/recipe choice lists kept in memory by each worker
+    REFERENCE_CACHE_SIZE = int(os.environ.get('REFERENCE_CACHE_SIZE', 512))
+
+    # Logged-in users whose details each worker keeps in memory, and for how many seconds before
+    # reading them again (which is also how long another worker's data changes can take to show)
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 30))
+
+    # Planner/log pages send each slot's recipe dropdown with only its chosen recipe, plus one shared
+    # list of all recipes that the page's script adds when a dropdown is opened; 0 renders every option
+    COMPACT_SLOTS = os.environ.get('COMPACT_SLOTS', '1') != '0'
+
+    # Release identifier folded into page ETags; when unset, the app's file modification times are used
+    RELEASE = os.environ.get('RELEASE') or os.environ.get('HEROKU_RELEASE_VERSION')
+
+    # Seconds browsers may reuse the fruit/veg substitution pages without revalidating
+    STATIC_PAGE_MAX_AGE = int(os.environ.get('STATIC_PAGE_MAX_AGE', 86400))
+
+    # Rendered page/fragment cache: memory (per worker), file or sqlite (shared by the workers on one
+    # machine, stored under PAGE_CACHE_PATH), or none
+    PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND', 'memory').lower()
+    PAGE_CACHE_PATH = os.environ.get('PAGE_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'keto-buddy-pages'))
+    PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+    # Logging level for the app logger; DEBUG also logs form payloads in the log view
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+    # Number of recent requests per endpoint kept for the /metrics percentiles
+    METRICS_WINDOW = int(os.environ.get('METRICS_WINDOW', 500))
+
+    # Comma-separated emails of users allowed to see /metrics
+    ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()}
+
+    # cProfile captures: admins add ?profile=1 to a request, or set a sample rate (0-1) for all requests
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'keto-buddy-profiles'))
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 200))
@@ -1,8 +1,7 @@
-from app import create_app, db
+from app import create_app
 
-app = create_app()
+# Run directly, this creates the tables in keto.db and applies pending migrations before serving
+app = create_app(upgrade_schema=__name__ == '__main__')
 
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()  # Creates tables in keto.db
     app.run(debug=True)